@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+arrowtools - Apache Arrow interchange for METRO results and extracted variables
+
+Results tables and get_variable() outputs are converted to pyarrow Tables with
+dictionary-encoded dimension columns, and written to / read from Arrow IPC files or
+streams. Reading an IPC file memory-maps it, so another process gets the data
+without copies. Requires the optional package pyarrow.
+
+Example:
+    arrowtools.write_ipc(stack.to_arrow('QER'), 'qer.arrow')   # in one process
+    table = arrowtools.read_ipc('qer.arrow')                     # in another one
+    m = metropy.metro_data('base')
+    m.attach_store(arrowtools.arrow_store(arrowtools.read_ipc('base.arrow')))
+
+@author: VanTongeren_F
+"""
+# third party imports
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc
+except ImportError: # optional dependency, only needed when the functions are used
+    pa = None
+
+# local imports
+from metro.keyspace import KEY_COLS
+from metro.stores import results_store
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('* ERROR * arrowtools needs the package pyarrow. '
+                          'Please install it with: pip install pyarrow')
+
+def _dictionary(values):
+    ''' returns values (array-like of labels) as a pyarrow DictionaryArray '''
+    codes, uniques = pd.factorize(values)
+    return pa.DictionaryArray.from_arrays(pa.array(codes.astype(np.int32)),
+                                          pa.array(np.asarray(uniques, dtype=object)))
+
+def results_to_arrow(results, dataID=None):
+    ''' returns a METRO results dataframe as a pyarrow Table with dictionary-encoded
+    key columns. If dataID is given, it is added as a (dictionary) first column '''
+    _require_pyarrow()
+    columns, names = [], []
+    if dataID is not None:
+        columns.append(pa.DictionaryArray.from_arrays(
+            pa.array(np.zeros(len(results), dtype=np.int32)), pa.array([dataID])))
+        names.append('dataID')
+    for c in KEY_COLS:
+        columns.append(_dictionary(results[c]))
+        names.append(c)
+    columns.append(pa.array(results['value'].to_numpy()))
+    names.append('value')
+    return pa.Table.from_arrays(columns, names=names)
+
+def arrow_to_results(table):
+    ''' returns a pyarrow Table of results rows as a METRO results dataframe '''
+    _require_pyarrow()
+    df = table.select(KEY_COLS + ['value']).to_pandas()
+    for c in KEY_COLS: # dictionary columns arrive as categoricals
+        df[c] = np.asarray(df[c], dtype=object)
+    return df
+
+def frame_to_arrow(df):
+    ''' returns a get_variable() output (or any dataframe or series with a row index)
+    as a pyarrow Table. The index levels become dictionary-encoded columns; the
+    column index is kept in the schema metadata so arrow_to_frame() restores it '''
+    _require_pyarrow()
+    series = isinstance(df, pd.Series)
+    name = b'' if not series or df.name is None else str(df.name).encode()
+    df = df.to_frame() if series else df.copy(deep=False)
+    df.index = pd.MultiIndex.from_arrays(
+        [pd.Categorical(df.index.get_level_values(l)) for l in range(df.index.nlevels)],
+        names=df.index.names)
+    table = pa.Table.from_pandas(df)
+    if series:
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                                               b'metro_series': name})
+    return table
+
+def arrow_to_frame(table):
+    ''' returns a Table written by frame_to_arrow() as a dataframe again '''
+    _require_pyarrow()
+    df = table.to_pandas()
+    df.index = pd.MultiIndex.from_arrays(
+        [np.asarray(df.index.get_level_values(l), dtype=object)
+         for l in range(df.index.nlevels)], names=df.index.names)
+    if df.index.nlevels == 1:
+        df.index = df.index.get_level_values(0)
+    metadata = table.schema.metadata or {}
+    if b'metro_series' in metadata: # written from a series, name in metadata
+        return df.iloc[:, 0].rename(metadata[b'metro_series'].decode() or None)
+    return df
+
+def write_ipc(table, path, stream=False):
+    ''' writes pyarrow Table table to an Arrow IPC file (stream=False) or stream
+    The dictionaries of all batches are unified first, as the IPC file format
+    does not allow them to change between batches '''
+    _require_pyarrow()
+    table = table.unify_dictionaries()
+    with pa.OSFile(path, 'wb') as sink:
+        new_writer = pa.ipc.new_stream if stream else pa.ipc.new_file
+        with new_writer(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def read_ipc(path, stream=False, memory_map=True):
+    ''' reads a pyarrow Table from an Arrow IPC file or stream
+    With memory_map=True the file is memory-mapped and the table refers to the
+    mapped pages, without copying them '''
+    _require_pyarrow()
+    source = pa.memory_map(path, 'r') if memory_map else pa.OSFile(path, 'rb')
+    reader = pa.ipc.open_stream(source) if stream else pa.ipc.open_file(source)
+    return reader.read_all()
+
+class arrow_store(results_store):
+    '''
+    A results store on a pyarrow Table of results rows, e.g. from read_ipc()
+    Rows of one variable are selected in Arrow, before conversion to pandas.
+    Can be attached to a metro_data object with metro_data.attach_store()
+    '''
+    def __init__(self, table):
+        _require_pyarrow()
+        self.table = table
+
+    def results(self):
+        return arrow_to_results(self.table)
+
+    def variable_rows(self, v):
+        return arrow_to_results(self.table.filter(pc.equal(self.table['variable'], v)))
+
+    def uniques(self, col):
+        values = self.table[col]
+        if pa.types.is_dictionary(values.type):
+            values = values.cast(values.type.value_type)
+        return values.unique().to_pylist()
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+#end class arrow_store
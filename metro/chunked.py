@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+chunked - out-of-core processing of very large METRO results files
+
+The results table is converted chunk by chunk into a columnar store on disk: a
+directory with one .npz file of integer-coded key columns and values per chunk, and
+a meta.json file with the labels of the codes. Variable extraction, filtering and
+aggregation then read one chunk at a time, so memory stays bounded by the chunk size
+and the size of the output.
+
+Example:
+    store = chunked.convert_chunked(gdx_path, 'big_store', chunk_rows=2_000_000)
+    store = chunked.chunked_results('big_store')       # reopen later
+    m = metropy.metro_data('big')
+    m.attach_store(store)                              # dimensions, sets, get_variable
+    store.get_variable('QER', filters={'dim5': 'uint'})
+    store.aggregate('QER', by=('dim1',))
+
+@author: VanTongeren_F
+"""
+# standard library imports
+import json
+import os
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from metro.keyspace import KEY_COLS
+from metro.stores import results_store
+
+RESULTS_COLS = KEY_COLS + ['value']
+
+def iter_gdx_results(path, chunk_rows=1000000, symbol='results'):
+    '''
+    Reads the records of symbol in GDX file path in chunks of chunk_rows records,
+    through the GAMS gdx API used by gdxpds, without loading the whole symbol.
+    Yields results dataframes with columns dim1, dim2, variable, dim4, dim5, value
+    '''
+    import gdxcc # GAMS python API, installed with gdxpds
+    from gdxpds.gdx import GdxFile
+
+    with GdxFile(lazy_load=True) as gdx:
+        gdx.read(path)
+        ret, symnr = gdxcc.gdxFindSymbol(gdx.H, symbol)
+        if not ret:
+            raise KeyError(f'* ERROR * There is no symbol "{symbol}" in {path}')
+        ret, n_records = gdxcc.gdxDataReadStrStart(gdx.H, symnr)
+
+        keys, values = [], []
+        for _ in range(n_records):
+            ret, elements, vals, _ = gdxcc.gdxDataReadStr(gdx.H)
+            keys.append(elements)
+            values.append(vals[gdxcc.GMS_VAL_LEVEL])
+            if len(values) == chunk_rows:
+                yield _records_frame(keys, values)
+                keys, values = [], []
+        gdxcc.gdxDataReadDone(gdx.H)
+        if values:
+            yield _records_frame(keys, values)
+
+def _records_frame(keys, values):
+    df = pd.DataFrame(keys, columns=KEY_COLS)
+    df['value'] = values
+    return df
+
+def convert_chunked(source, store_dir, chunk_rows=1000000):
+    '''
+    Converts METRO results into a chunked columnar store in directory store_dir
+
+    PARAMETERS
+    ----------
+    source: path to a GDX file (read with iter_gdx_results()), a results dataframe,
+            or an iterable of results dataframes (e.g. pandas.read_csv(..., chunksize=))
+    store_dir: directory of the store, created if necessary
+    chunk_rows: number of rows per chunk when source is a GDX file or a dataframe
+
+    RETURNS
+    -------
+    a chunked_results store on store_dir
+    '''
+    if isinstance(source, str):
+        chunks = iter_gdx_results(source, chunk_rows)
+    elif isinstance(source, pd.DataFrame):
+        chunks = (source.iloc[i:i + chunk_rows] for i in range(0, len(source), chunk_rows))
+    else:
+        chunks = source
+
+    os.makedirs(store_dir, exist_ok=True)
+    labels = {c: {} for c in KEY_COLS} # label: code, in order of first appearance
+    n_rows = []
+    for i, chunk in enumerate(chunks):
+        chunk = chunk.set_axis(RESULTS_COLS, axis=1)
+        arrays = {'value': chunk['value'].to_numpy(dtype=np.float64)}
+        for c in KEY_COLS:
+            codes = chunk[c].map(labels[c])
+            new = pd.unique(chunk[c][codes.isna()])
+            labels[c].update(zip(new, range(len(labels[c]), len(labels[c]) + len(new))))
+            if len(new):
+                codes = chunk[c].map(labels[c])
+            arrays[c] = codes.to_numpy(dtype=np.int32)
+        with open(os.path.join(store_dir, f'chunk_{i}.npz'), 'wb') as f:
+            np.savez(f, **arrays)
+        n_rows.append(len(chunk))
+
+    meta = {'chunks': n_rows, 'labels': {c: list(labels[c]) for c in KEY_COLS}}
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return chunked_results(store_dir)
+#end convert_chunked()
+
+class chunked_results(results_store):
+    '''
+    A chunked columnar results store on disk, written by convert_chunked()
+    Can be attached to a metro_data object with metro_data.attach_store()
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.chunk_rows = meta['chunks']
+        self.labels = {c: np.array(meta['labels'][c], dtype=object) for c in KEY_COLS}
+
+    def __len__(self):
+        return sum(self.chunk_rows)
+
+    def _code(self, col, label):
+        ''' returns the code of label in column col, -1 if not found '''
+        found = np.flatnonzero(self.labels[col] == label)
+        return found[0] if len(found) else -1
+
+    def _chunks(self, v=None, filters=None):
+        ''' yields the code and value arrays of each chunk, restricted to the rows
+        of variable v and the rows matching filters {dim: label or list of labels} '''
+        masks = {}
+        if v is not None:
+            masks['variable'] = np.array([self._code('variable', v)])
+        for c, labels in (filters or {}).items():
+            if isinstance(labels, str):
+                labels = [labels]
+            masks[c] = np.array([self._code(c, l) for l in labels])
+
+        for i in range(len(self.chunk_rows)):
+            with np.load(os.path.join(self.store_dir, f'chunk_{i}.npz')) as npz:
+                chunk = {c: npz[c] for c in RESULTS_COLS}
+            if masks:
+                keep = np.logical_and.reduce([np.isin(chunk[c], codes)
+                                              for c, codes in masks.items()])
+                chunk = {c: a[keep] for c, a in chunk.items()}
+            yield chunk
+
+    def _decode(self, chunk):
+        df = pd.DataFrame({c: self.labels[c][np.asarray(chunk[c])] for c in KEY_COLS
+                           if c in chunk})
+        df['value'] = np.asarray(chunk['value'])
+        return df
+
+    def results(self):
+        ''' returns the complete results dataframe. NOTE: loads everything in memory '''
+        frames = [self._decode(chunk) for chunk in self._chunks()]
+        if not frames:
+            return pd.DataFrame(columns=RESULTS_COLS)
+        return pd.concat(frames, ignore_index=True)
+
+    def variable_rows(self, v):
+        frames = [self._decode(chunk) for chunk in self._chunks(v)]
+        if not frames:
+            return pd.DataFrame(columns=RESULTS_COLS)
+        return pd.concat(frames, ignore_index=True)
+
+    def uniques(self, col):
+        return list(self.labels[col]) # labels are added in order of first appearance
+
+    def _partial_sums(self, v, by, filters):
+        ''' sums the rows of v matching filters over the dims not in by, chunk by chunk,
+        returns a Series indexed by the codes of by, or a float if by is empty '''
+        partials = []
+        for chunk in self._chunks(v, filters):
+            df = pd.DataFrame({c: chunk[c] for c in by})
+            df['value'] = chunk['value']
+            partials.append(df.groupby(list(by), sort=False)['value'].sum() if by else
+                            pd.Series([df['value'].sum()]))
+        if not partials:
+            partials = [pd.Series([], dtype=np.float64)]
+        if not by:
+            return pd.concat(partials).sum()
+        return pd.concat(partials).groupby(level=list(by), sort=False).sum()
+
+    def aggregate(self, v, by=(), filters=None):
+        '''
+        Sums variable v over all its dimensions not in by, chunk by chunk
+
+        PARAMETERS
+        ----------
+        v:  variable name
+        by: dimensions to keep, e.g. ('dim1',)
+        filters: optional dict {dim: label or list of labels} selecting rows
+
+        RETURNS
+        -------
+        a Series indexed by the dims in by, or a float if by is empty
+        '''
+        sums = self._partial_sums(v, tuple(by), filters)
+        if not by:
+            return float(sums)
+        index = pd.MultiIndex.from_arrays(
+            [self.labels[d][sums.index.get_level_values(d)] for d in by], names=list(by))
+        if len(by) == 1:
+            index = index.get_level_values(0)
+        return pd.Series(sums.to_numpy(), index=index, name='value').sort_index()
+
+    def get_variable(self, v, filters=None):
+        ''' returns values of variable v (of the rows matching filters, see aggregate())
+        in the same layout as metro_data.get_variable() '''
+        if self._code('variable', v) < 0:
+            print(f'* ERROR * There is no variable "{v}" in the results file')
+            return None
+        dims = ['dim1', 'dim2', 'dim4', 'dim5']
+        sums = self._partial_sums(v, dims, filters).reset_index()
+        if sums.empty:
+            print(f'* ERROR * No rows of variable "{v}" match the filters {filters}')
+            return None
+        tmp = self._decode(sums)
+        for c in dims[:]: # remove columns that only have 'empty' as value
+            if (tmp[c] == 'empty').all():
+                dims.remove(c)
+        return tmp.groupby(dims)[['value']].sum().unstack()
+
+#end class chunked_results
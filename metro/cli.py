@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+cli - command line interface for batch runs without interactive scripts
+
+Installed as the console script "metro" by pip install (see setup.cfg):
+    metro convert gdx_dir store_dir --workers 8 [--layout mapped]
+    metro report store_dir --sets sets.xlsx --tables tables.json --out tables/report.xlsx
+
+convert: converts every .gdx file in gdx_dir in parallel into a columnar copy
+         <name>.npz in store_dir (see stores.write_columnar), much faster to read again,
+         or with --layout mapped into <name>.mmap (see stores.write_mapped), of which
+         only the variables used are read
+report:  makes the macro_table and the tables in a table spec file for every scenario
+         (.mmap, .npz or .gdx file) in a directory, in worker processes, and writes them to
+         one Excel file with a sheet per table and the scenarios side by side
+
+Files that fail are skipped and reported. Both commands print a JSON summary with
+the timings and failures on stdout, and exit with status 1 if any file failed.
+
+A table spec file is a JSON list of tables: {"name": sheet name, "variable": name,
+"by": optional list of dims to keep, summing over the others}, e.g.
+    [{"name": "Exports", "variable": "QXD", "by": ["dim1"]},
+     {"name": "Employment", "variable": "QFD"}]
+
+@author: VanTongeren_F
+"""
+# standard library imports
+import argparse
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# third party imports
+import pandas as pd
+
+# local imports
+from metro import metropy
+from metro import runner
+from metro.stores import write_columnar, write_mapped
+
+def _last_line(message):
+    ''' returns the last line of an error message, e.g. the exception of a traceback '''
+    return message.strip().splitlines()[-1]
+
+def _stdout_to_stderr():
+    ''' worker initializer: progress messages go to stderr, stdout is kept for
+    the JSON summary '''
+    sys.stdout = sys.stderr
+
+def _convert_file(gdx_path, out_path)-> float:
+    ''' writes a copy of GDX file gdx_path to out_path (in a worker), with
+    write_mapped() for a .mmap file, else write_columnar(). Returns the seconds spent '''
+    t0 = time.perf_counter()
+    data = metropy._read_gdx(gdx_path)
+    if out_path.endswith('.mmap'):
+        write_mapped(data['results'], out_path)
+    else:
+        write_columnar(data, out_path)
+    return time.perf_counter() - t0
+
+def convert(gdx_dir, store_dir, workers=None, layout='npz')-> dict:
+    ''' converts all .gdx files in gdx_dir into .npz files (layout='npz') or .mmap files
+    (layout='mapped') in store_dir, using workers processes. Returns the summary of the run '''
+    ext = '.mmap' if layout == 'mapped' else '.npz'
+    t0 = time.perf_counter()
+    files = {f[:-4]: os.path.join(gdx_dir, f) for f in sorted(os.listdir(gdx_dir))
+             if f.lower().endswith('.gdx')}
+    os.makedirs(store_dir, exist_ok=True)
+
+    seconds, failed = {}, {}
+    with ProcessPoolExecutor(workers, initializer=_stdout_to_stderr) as executor:
+        futures = {n: executor.submit(_convert_file, path, os.path.join(store_dir, n + ext))
+                   for n, path in files.items()}
+        for n, future in futures.items():
+            try:
+                seconds[n] = round(future.result(), 3)
+            except Exception:
+                message = traceback.format_exc()
+                failed[n] = _last_line(message)
+                print(f'* ERROR * converting "{files[n]}" failed:\n{message}', file=sys.stderr)
+
+    return {'command': 'convert', 'files': len(files),
+            'succeeded': [n for n in files if n in seconds],
+            'failed': failed, 'seconds': seconds,
+            'wall_seconds': round(time.perf_counter() - t0, 3)}
+#end convert()
+
+def _scenario_tables(metro_obj, specs)-> dict:
+    ''' makes the macro_table and the tables in specs for one scenario (in a worker)
+    Returns {table name: dataframe} '''
+    tables = {'Macro': metropy.macro_table(metro_obj)}
+    for spec in specs:
+        if spec.get('by'): # sums over the other dims
+            df = metro_obj.get_total(spec['variable'], tuple(spec['by']))
+        else:
+            df = metro_obj.get_variable(spec['variable'])
+        if df is None:
+            raise KeyError(f'* ERROR * There is no variable "{spec["variable"]}" '
+                           f'for table "{spec["name"]}"')
+        if isinstance(df, pd.Series):
+            df = df.to_frame('value')
+        elif not isinstance(df, pd.DataFrame): # by dims not used by the variable
+            df = pd.DataFrame({'value': [df]}, index=['TOTAL'])
+        tables[spec['name']] = df
+    return tables
+
+def scenario_stack(source_dir, setpath=' ')-> metropy.result_stack:
+    ''' returns a result_stack with a metro_data object per .mmap, .npz or .gdx file in
+    source_dir, named after the file. Of files with the same name, the .mmap, else the
+    .npz copy is used '''
+    rank = {'.mmap': 0, '.npz': 1, '.gdx': 2}
+    files = {}
+    found = [os.path.splitext(f) + (f,) for f in os.listdir(source_dir)]
+    for name, ext, f in sorted(found, key=lambda x: rank.get(x[1].lower(), 3)):
+        if ext.lower() in rank and name not in files:
+            files[name] = os.path.join(source_dir, f)
+    files = dict(sorted(files.items()))
+
+    stack = metropy.result_stack()
+    for name, path in files.items():
+        m = metropy.metro_data(name)
+        m.path = path
+        m.setpath = setpath
+        m.legend = name
+        stack.add_result(m)
+    return stack
+
+def report(source_dir, out, specs=(), setpath=' ', workers=None, retries=0)-> dict:
+    ''' writes the macro_table and the tables in specs (see the module docstring) of
+    all scenarios in source_dir to Excel file out. Returns the summary of the run '''
+    t0 = time.perf_counter()
+    stack = scenario_stack(source_dir, setpath)
+    with ProcessPoolExecutor(workers, initializer=_stdout_to_stderr) as executor:
+        run = runner.map_reduce(stack, functools.partial(_scenario_tables, specs=list(specs)),
+                                executor=executor, retries=retries)
+
+    tables = metropy.out_tables()
+    tables['ReadMe'] = [f'METRO report of {source_dir}',
+                        f'scenarios: {", ".join(run.results.keys())}']
+    if run.failed:
+        tables['ReadMe'].append(f'failed scenarios: {", ".join(run.failed.keys())}')
+    names = ['Macro'] + [spec['name'] for spec in specs]
+    if run.results:
+        for name in names:
+            df = pd.concat({k: v[name] for k, v in run.results.items()}, axis=1)
+            metropy.add_to_out_tables(tables, df, sheet_name=name[:31], info=name)
+        t1 = time.perf_counter()
+        metropy.write_to_excel(tables, os.path.abspath(out))
+        write_seconds = time.perf_counter() - t1
+
+    summary = {'command': 'report', **run.summary(), 'tables': names,
+               'output': out if run.results else None,
+               'write_seconds': round(write_seconds, 3) if run.results else 0.0}
+    summary['failed'] = {k: _last_line(v) for k, v in run.failed.items()}
+    summary['wall_seconds'] = round(time.perf_counter() - t0, 3)
+    return summary
+#end report()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='metro',
+                                     description='batch processing of METRO results files')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('convert', help='convert GDX files into columnar .npz files')
+    p.add_argument('gdx_dir', help='directory with the .gdx files')
+    p.add_argument('store_dir', help='output directory of the .npz files')
+    p.add_argument('--workers', type=int, default=None,
+                   help='number of worker processes (default: number of CPUs)')
+    p.add_argument('--layout', choices=['npz', 'mapped'], default='npz',
+                   help='npz: columnar copies, mapped: memory-mapped per-variable files')
+
+    p = commands.add_parser('report', help='make tables for all scenarios')
+    p.add_argument('source_dir', help='directory with the .mmap, .npz and/or .gdx files')
+    p.add_argument('--out', required=True, help='output Excel file (.xlsx)')
+    p.add_argument('--tables', default=None, help='JSON table spec file')
+    p.add_argument('--sets', default=' ', help='xlsx file with the METRO sets')
+    p.add_argument('--workers', type=int, default=None,
+                   help='number of worker processes (default: number of CPUs)')
+    p.add_argument('--retries', type=int, default=0,
+                   help='number of times failed scenarios are tried again')
+
+    args = parser.parse_args(argv)
+    with contextlib.redirect_stdout(sys.stderr): # keep stdout for the summary
+        if args.command == 'convert':
+            summary = convert(args.gdx_dir, args.store_dir, args.workers, args.layout)
+        else:
+            specs = []
+            if args.tables is not None:
+                with open(args.tables) as f:
+                    specs = json.load(f)
+            summary = report(args.source_dir, args.out, specs, args.sets, args.workers,
+                             args.retries)
+
+    print(json.dumps(summary, indent=2))
+    return 1 if summary['failed'] else 0
+#end main()
+
+if __name__ == "__main__":
+    sys.exit(main())
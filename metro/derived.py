@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+derived - derived variables, defined as expressions over other METRO variables
+
+Example:
+    s1.define('TBAL', 'rEXPORT - rIMPORT')                      # expression string
+    s1.define('EXPSHR', 'rEXPORT / rGDPEXP * 100')
+    s1.define('TOTQER', lambda QER: QER.sum(axis=1))            # function of variables
+    s1.get_variable('TBAL')
+
+@author: VanTongeren_F
+"""
+import ast
+import inspect
+
+import numpy as np
+
+# names that can be used in expression strings besides variable names
+EXPR_NAMES = {'np': np, 'abs': abs, 'min': min, 'max': max}
+
+class derived_variable(object):
+    '''
+    A variable computed from other variables (native or derived)
+
+    name: name of the derived variable
+    expr: either an expression string over variable names, e.g. 'rEXPORT - rIMPORT',
+          which may also use np, abs, min and max; or a function whose argument
+          names are variable names, e.g. lambda rEXPORT, rIMPORT: rEXPORT - rIMPORT
+    deps: optional list of the variables expr depends on. For a function, the values
+          of deps are passed as positional arguments in that order.
+    '''
+    def __init__(self, name, expr, deps=None):
+        self.name = name
+        self.expr = expr
+        if callable(expr):
+            self._code = None
+            self.deps = list(deps) if deps is not None else \
+                list(inspect.signature(expr).parameters)
+        else:
+            tree = ast.parse(expr, mode='eval')
+            self._code = compile(tree, f'<derived variable {name}>', 'eval')
+            names = [n.id for n in ast.walk(tree) if isinstance(n, ast.Name)]
+            self.deps = list(deps) if deps is not None else \
+                list(dict.fromkeys(n for n in names if n not in EXPR_NAMES))
+
+    def evaluate(self, inputs):
+        ''' returns the value of the variable, given a dict {dependency name: value} '''
+        if self._code is None:
+            return self.expr(*[inputs[d] for d in self.deps])
+        return eval(self._code, {'__builtins__': {}, **EXPR_NAMES}, dict(inputs))
+
+    def __str__(self):
+        if self._code is None:
+            return f'{self.name} = {self.expr.__name__}({", ".join(self.deps)})'
+        return f'{self.name} = {self.expr}'
+
+#end class derived_variable
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+keyspace - aligns the results tables of several METRO scenarios on one key space,
+and indexes the rows of a results table by sorted integer-coded keys
+
+@author: VanTongeren_F
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+KEY_COLS = ['dim1', 'dim2', 'variable', 'dim4', 'dim5'] # key columns of a results table
+INDEX_COLS = ['variable', 'dim1', 'dim2', 'dim4', 'dim5'] # sort order of sorted_index
+
+class key_space(object):
+    '''
+    The union of the (dim1, dim2, variable, dim4, dim5) keys found in a list of METRO
+    results dataframes, mapped to integer row ids 0..n-1.
+    Each key column is stored as integer codes into a list of categories. Rows are
+    grouped by variable (in order of first appearance), so the rows of one variable
+    are the contiguous block of row ids returned by var_range(v).
+    '''
+    def __init__(self, frames):
+        all_codes = {}
+        self.categories = {}
+        for c in KEY_COLS:
+            codes, uniques = pd.factorize(pd.concat([f[c] for f in frames],
+                                                    ignore_index=True))
+            all_codes[c] = codes
+            self.categories[c] = pd.Index(uniques)
+
+        combined = self._combine(all_codes)
+        _, first = np.unique(combined, return_index=True)
+        first = np.sort(first) # keep order of first appearance
+        var_order = np.argsort(all_codes['variable'][first], kind='stable')
+        rows = first[var_order]
+
+        self.codes = {c: all_codes[c][rows].astype(np.int32) for c in KEY_COLS}
+        self._combined = combined[rows]
+        self._sorter = np.argsort(self._combined)
+        self._bounds = np.searchsorted(self.codes['variable'],
+                                       np.arange(len(self.categories['variable']) + 1))
+
+    def __len__(self):
+        return len(self._combined)
+
+    @property
+    def nbytes(self):
+        ''' approximate memory used by the key space in bytes '''
+        return (sum(a.nbytes for a in self.codes.values()) + self._combined.nbytes
+                + self._sorter.nbytes)
+
+    def _combine(self, codes):
+        ''' combines the codes of the key columns into a single int64 key '''
+        combined = np.zeros(len(codes[KEY_COLS[0]]), dtype=np.int64)
+        for c in KEY_COLS:
+            combined = combined * len(self.categories[c]) + codes[c]
+        return combined
+
+    def lookup(self, frame):
+        ''' returns the row ids of the keys in results dataframe frame, -1 if not found '''
+        codes = {c: self.categories[c].get_indexer(frame[c]) for c in KEY_COLS}
+        valid = np.logical_and.reduce([codes[c] >= 0 for c in KEY_COLS])
+        combined = self._combine(codes)
+        if len(self) == 0:
+            return np.full(len(frame), -1, dtype=np.int64)
+
+        sorted_keys = self._combined[self._sorter]
+        i = np.minimum(np.searchsorted(sorted_keys, combined), len(self) - 1)
+        found = valid & (sorted_keys[i] == combined)
+        return np.where(found, self._sorter[i], -1)
+
+    def align(self, frame, dtype=np.float64):
+        ''' returns the values of results dataframe frame on the key space:
+        an array of float dtype and length len(self), NaN for keys not in frame,
+        and a boolean array marking the keys present in frame '''
+        pos = self.lookup(frame)
+        found = pos >= 0
+        values = np.full(len(self), np.nan, dtype=dtype)
+        present = np.zeros(len(self), dtype=bool)
+        values[pos[found]] = frame['value'].to_numpy()[found]
+        present[pos[found]] = True
+        return values, present
+
+    def var_range(self, v):
+        ''' returns (start, stop) of the row ids of variable v, (0, 0) if not found'''
+        code = self.categories['variable'].get_indexer([v])[0]
+        if code < 0:
+            return 0, 0
+        return int(self._bounds[code]), int(self._bounds[code + 1])
+
+    def uniques(self, col, rows):
+        ''' returns the labels of key column col in row ids rows, in order of appearance '''
+        codes = self.codes[col][rows]
+        _, first = np.unique(codes, return_index=True)
+        return list(self.categories[col].to_numpy()[codes[np.sort(first)]])
+
+    def frame(self, rows, values):
+        ''' returns a results dataframe with the keys of row ids rows and values '''
+        df = pd.DataFrame({c: self.categories[c].to_numpy()[self.codes[c][rows]]
+                           for c in KEY_COLS})
+        df['value'] = values
+        return df
+
+#end class key_space
+
+class scenario_matrix(object):
+    '''
+    The values of several scenarios on one key_space: a keys x scenarios float matrix
+    (NaN where a scenario has no value for a key), built by result_stack.build_matrix().
+    Cross-scenario arithmetic is done on the columns of the matrix with NumPy; labels
+    are only attached to the output.
+
+    Every method takes an optional variable v: without it, the result is a NumPy array
+    over all keys; with it, only the rows of v are computed and returned as a dataframe
+    indexed by the used dimensions of v, with the scenarios (dataIDs) as columns.
+
+    Example:
+        mat = stack.build_matrix()
+        mat.pct_diff('base', v='QER')                # like pct_diff_list, long layout
+        mat.stats(v='rGDPEXP')                       # ensemble statistics per region
+    '''
+    def __init__(self, keys, values, dataIDs):
+        self.keys = keys
+        self.values = values
+        self.dataIDs = list(dataIDs)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.keys.nbytes
+
+    def _col(self, dataID):
+        return self.dataIDs.index(dataID)
+
+    def _block(self, v):
+        ''' returns the rows of the matrix for variable v (all rows if v is None) '''
+        if v is None:
+            return self.values
+        start, stop = self.keys.var_range(v)
+        return self.values[start:stop]
+
+    def _out(self, v, block, columns):
+        ''' attaches labels to block, the rows of variable v, if v is given '''
+        if v is None:
+            return block
+        start, stop = self.keys.var_range(v)
+        rows = np.arange(start, stop)
+        labels = {d: self.keys.categories[d].to_numpy()[self.keys.codes[d][rows]]
+                  for d in ['dim1', 'dim2', 'dim4', 'dim5']}
+        used = [d for d in labels if not (labels[d] == 'empty').all()]
+        index = pd.MultiIndex.from_arrays([labels[d] for d in used], names=used)
+        if len(used) == 1:
+            index = index.get_level_values(0)
+        return pd.DataFrame(block, index=index, columns=columns).sort_index()
+
+    def get_var(self, v):
+        ''' returns the values of variable v in all scenarios, scenarios in columns '''
+        return self._out(v, self._block(v), self.dataIDs)
+
+    def diff(self, base, other, v=None):
+        ''' returns other - base, for dataIDs base and other '''
+        block = self._block(v)
+        res = block[:, self._col(other)] - block[:, self._col(base)]
+        return self._out(v, res[:, None], [other])
+
+    def ratio(self, base, other, v=None):
+        ''' returns other / base, for dataIDs base and other '''
+        block = self._block(v)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = block[:, self._col(other)] / block[:, self._col(base)]
+        return self._out(v, res[:, None], [other])
+
+    def pct_diff(self, base, others=None, v=None):
+        ''' returns (other/base - 1)*100 for all dataIDs in others (default: all
+        scenarios but base), one column per scenario in others '''
+        if others is None:
+            others = [s for s in self.dataIDs if s != base]
+        block = self._block(v)
+        cols = [self._col(s) for s in others]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = (block[:, cols] / block[:, [self._col(base)]] - 1.0) * 100
+        return self._out(v, res, others)
+
+    def rank(self, v=None, ascending=True):
+        ''' returns the rank (1 = smallest, or largest if not ascending) of every
+        scenario for each key. Ties are ranked in scenario order, keys missing in a
+        scenario are ranked last '''
+        block = self._block(v)
+        keys = block if ascending else -block
+        order = np.argsort(keys, axis=1, kind='stable') # NaN sorts last
+        ranks = np.empty(block.shape)
+        np.put_along_axis(ranks, order, np.arange(1, block.shape[1] + 1)[None, :], axis=1)
+        return self._out(v, ranks, self.dataIDs)
+
+    def stats(self, v=None):
+        ''' returns the ensemble statistics over the scenarios for each key: columns
+        count, mean, stdev (ddof=1), min and max, ignoring missing values
+        Means and stdevs are computed in float64, also for a float32 matrix '''
+        block = self._block(v)
+        with warnings.catch_warnings(): # all-NaN rows give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            res = np.column_stack([np.sum(~np.isnan(block), axis=1),
+                                   np.nanmean(block, axis=1, dtype=np.float64),
+                                   np.nanstd(block, axis=1, ddof=1, dtype=np.float64),
+                                   np.nanmin(block, axis=1),
+                                   np.nanmax(block, axis=1)])
+        return self._out(v, res, ['count', 'mean', 'stdev', 'min', 'max'])
+
+#end class scenario_matrix
+
+class sorted_index(object):
+    '''
+    The rows of a METRO results dataframe sorted by their integer-coded keys in the
+    order (variable, dim1, dim2, dim4, dim5). The rows matching a prefix of the keys,
+    e.g. a variable, or a variable and an origin region, are a contiguous range found
+    with two binary searches, so reading them costs O(log n + k) for k rows.
+    The index keeps its own copy of the codes (int32) and values.
+
+    Example:
+        idx = sorted_index(results)
+        idx.rows('QER', dim1='r0')                  # one origin region of QER
+        idx.values('QER', dim1='r0', dim2='w1')     # view on one region-pair block
+    '''
+    def __init__(self, results):
+        codes = {}
+        self.categories = {}
+        for c in INDEX_COLS:
+            codes[c], uniques = pd.factorize(results[c])
+            self.categories[c] = pd.Index(uniques)
+        self._sizes = [len(self.categories[c]) for c in INDEX_COLS]
+
+        combined = self._combine([codes[c] for c in INDEX_COLS])
+        order = np.argsort(combined, kind='stable')
+        self._combined = combined[order]
+        self.codes = {c: codes[c][order].astype(np.int32) for c in INDEX_COLS}
+        self._values = results['value'].to_numpy()[order]
+
+    def __len__(self):
+        return len(self._combined)
+
+    @property
+    def nbytes(self):
+        return (self._combined.nbytes + self._values.nbytes
+                + sum(a.nbytes for a in self.codes.values()))
+
+    def _combine(self, codes):
+        ''' combines the codes of the leading index columns into a single int64 key,
+        the missing trailing columns counting as code 0 '''
+        combined = np.zeros(np.shape(codes[0]), dtype=np.int64)
+        for i, size in enumerate(self._sizes):
+            combined = combined * size + (codes[i] if i < len(codes) else 0)
+        return combined
+
+    def range(self, v, **dims):
+        '''
+        Returns (start, stop, mask) of the sorted rows of variable v matching dims
+        {dim: label}. The leading dims in index order (dim1, dim2, dim4, dim5) are
+        found by binary search; mask is None, or a boolean array over start:stop
+        selecting the rows that also match the other dims.
+        A label that is not in the results gives an empty range.
+        '''
+        labels = [v] + [dims.get(c) for c in INDEX_COLS[1:]]
+        prefix = []
+        for c, label in zip(INDEX_COLS, labels):
+            if label is None:
+                break
+            prefix.append(self.categories[c].get_indexer([label])[0])
+        if min(prefix) < 0:
+            return 0, 0, None
+
+        lo = self._combine(prefix)
+        hi = self._combine(prefix[:-1] + [prefix[-1] + 1])
+        start, stop = np.searchsorted(self._combined, [lo, hi])
+
+        rest = {c: l for c, l in zip(INDEX_COLS[len(prefix):], labels[len(prefix):])
+                if l is not None}
+        if not rest:
+            return int(start), int(stop), None
+        mask = np.ones(stop - start, dtype=bool)
+        for c, label in rest.items():
+            code = self.categories[c].get_indexer([label])[0]
+            mask &= self.codes[c][start:stop] == code
+        return int(start), int(stop), mask
+
+    def values(self, v, **dims):
+        ''' returns the values of the rows of v matching dims, see range(); a read-only
+        view on the index when dims is a prefix of the index order '''
+        start, stop, mask = self.range(v, **dims)
+        values = self._values[start:stop]
+        if mask is not None:
+            return values[mask]
+        values = values.view()
+        values.flags.writeable = False
+        return values
+
+    def rows(self, v, **dims):
+        ''' returns the rows of v matching dims (see range()) as a results dataframe '''
+        start, stop, mask = self.range(v, **dims)
+        rows = slice(start, stop) if mask is None else np.arange(start, stop)[mask]
+        df = pd.DataFrame({c: self.categories[c].to_numpy()[self.codes[c][rows]]
+                           for c in KEY_COLS})
+        df['value'] = self._values[rows]
+        return df
+
+#end class sorted_index
@@ -7,18 +7,82 @@ Created on Wed Sep 30 12:26:11 2020
 metropy - Module to convert OECD METRO results GDX to Python using pandas dataframe
 """
 # standard library imports
+import asyncio
 import os
 import sys
 import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
 
 # third party imports
 import gdxpds          # module to read gdx into pandas, see https://github.com/NREL/gdx-pandas
+import numpy as np
 import pandas as pd
 
 from openpyxl import Workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.styles import Font
 
+# local imports
+from metro import arrowtools
+from metro.derived import derived_variable
+from metro.keyspace import key_space, scenario_matrix, sorted_index
+from metro.rollup import rollup_cube, aggregate
+from metro.stores import keyed_store, delta_store, mapped_store, write_columnar, read_columnar
+
+
+#%% reading GDX files
+_pending_loads = {} # (event loop, absolute path): asyncio.Task parsing that file
+
+def _read_gdx(path):
+    ''' Reads a METRO results GDX file into a dict of dataframes
+    A .npz file is read as a columnar copy written by stores.write_columnar(), a .mmap
+    file as a file written by stores.write_mapped() '''
+    if path.endswith('.npz'):
+        return read_columnar(path)
+    if path.endswith('.mmap'):
+        return {'results': mapped_store(path).results()}
+    data = gdxpds.to_dataframes(path)
+    data['results'].columns=['dim1','dim2','variable','dim4','dim5','value']
+    #NOTE: the META and META_p information is not read in correctly.
+    #This is a type conversion issue in gdxpds. So delete it from dict until solution found
+    if 'META'in data.keys():  del data['META']
+    if 'META_p'in data.keys(): del data['META_p']
+    return data
+
+async def _aparse_gdx(path, executor, semaphore):
+    ''' Runs _read_gdx(path) in executor, holding semaphore (if any) while parsing '''
+    loop = asyncio.get_running_loop()
+    if semaphore is None:
+        print(f'Loading GDX file {path}\n')
+        return await loop.run_in_executor(executor, _read_gdx, path)
+    async with semaphore:
+        print(f'Loading GDX file {path}\n')
+        return await loop.run_in_executor(executor, _read_gdx, path)
+
+async def _aread_gdx(path, executor=None, semaphore=None):
+    ''' Async counterpart of _read_gdx()
+    Concurrent calls for the same file share one parse: the first caller starts it,
+    later callers await the same task. The task is shielded, so a cancelled caller
+    does not cancel the parse for the others.
+    '''
+    loop = asyncio.get_running_loop()
+    key = (loop, os.path.abspath(path))
+    task = _pending_loads.get(key)
+    if task is None:
+        task = loop.create_task(_aparse_gdx(path, executor, semaphore))
+        _pending_loads[key] = task
+        task.add_done_callback(lambda t: _pending_loads.pop(key, None))
+    return await asyncio.shield(task)
+
+def _nbytes(value):
+    ''' returns the bytes of value, a dataframe, series or number '''
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    return int(np.asarray(value).nbytes)
 
 #%% classes
 class metro_data(object):
@@ -29,10 +93,51 @@ class metro_data(object):
         self.dataID = dataID
         self._data = {}
         self._sets = {}
-        self.path = " "
+        self._path = " "
         self.setpath = " "
         self.legend = None # use to describe data
         self._fullname = {}
+        self._store = None # stores.results_store replacing self._data['results']
+        self._budget = None # _memory_budget of the result_stack, if any
+        self._spill = None  # (path, columnar copy of data) written on eviction
+        self._rollup = None # rollup_cube built by build_rollup()
+        self._index = None  # keyspace.sorted_index built by build_index()
+        self._derived = {}  # name: derived_variable, see define()
+        self._derived_values = {} # name: (value of derived variable, bytes), memoized
+        self._cache = OrderedDict() # key: (get_variable output, bytes), in LRU order
+        self.cache_max_bytes = 64 * 2**20 # byte budget of the cache, see set_cache()
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._precision = np.dtype(np.float64) # dtype of the values, see set_precision()
+
+    @property
+    def path(self):
+        ''' Path to the METRO results GDX file. Reassigning it drops the data loaded from
+        the previous file, an attached store and everything computed from it (cached
+        variables, derived values, rollup cube)
+        A .mmap file (see stores.write_mapped()) is attached as a stores.mapped_store,
+        so only the variables used are read '''
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        if path != self._path:
+            self._store = None # store of the previous file
+            if path.endswith('.mmap') and os.path.isfile(path):
+                self._store = mapped_store(path)
+            if self._data: # data of the previous file
+                self._data = {}
+                if self._budget is not None:
+                    self._budget.forget(self)
+        self._path = path
+        self._invalidate()
+
+    def _invalidate(self):
+        ''' Forgets everything computed from the data: the get_variable() cache, the
+        memoized derived variables, the rollup cube and the sorted index '''
+        self._cache.clear()
+        self._derived_values.clear()
+        self._rollup = None
+        self._index = None
 
     @property
     def fullname(self):
@@ -44,24 +149,91 @@ class metro_data(object):
         ''' Contains a METRO results file
         Loads file on <path> from disk if not already loaded
         '''
+        if self._store is not None: # results kept in a store, rebuild the table
+            data = dict(self._data)
+            data['results'] = self._cast(self._store.results())
+            return data
+
         if self._data:
+            if self._budget is not None:
+                self._budget.touch(self)
             return self._data #data already read, return directly
 
-        try:
-            print(f'Loading GDX file {self.path}\n')
-            self._data = gdxpds.to_dataframes(self.path)
-            self._data['results'].columns=['dim1','dim2','variable','dim4','dim5','value']
-            #NOTE: the META and META_p information is not read in correctly.
-            #This is a type conversion issue in gdxpds. So delete it from dict until solution found
-            if 'META'in self._data.keys():  del self._data['META']
-            if 'META_p'in self._data.keys(): del self._data['META_p']
+        if self._has_spill():
+            self._data = read_columnar(self._spill[1]) # reload evicted data
+            self._data['results'] = self._cast(self._data['results'])
+            if self._budget is not None: # the budget may have been removed since
+                self._budget.reloads += 1
+        else:
+            try:
+                print(f'Loading GDX file {self.path}\n')
+                self._data = _read_gdx(self.path)
+                self._data['results'] = self._cast(self._data['results'])
+                self._invalidate()
+
+            except gdxpds.Error as msg:
+                print(f'{msg} \n'
+                      f'Please use metro_obj.path = <full path to gdx file containing METRO results>\n')
+
+                sys.exit()
+
+        if self._budget is not None:
+            self._budget.touch(self)
+        return self._data
 
+    def attach_store(self, store):
+        ''' Uses store (a stores.results_store, e.g. chunked.chunked_results) for the
+        results table instead of reading the GDX file on <path> '''
+        self._store = store
+        self._invalidate()
+
+    def _has_spill(self):
+        ''' True if a columnar copy of the data at the current path exists '''
+        return (self._spill is not None and self._spill[0] == self.path
+                and os.path.isfile(self._spill[1]))
+
+    def _evict(self, spill_dir):
+        ''' Drops the loaded data, after writing a columnar copy to spill_dir if necessary '''
+        if not self._has_spill():
+            fn = os.path.join(spill_dir, f'{self.dataID}_{id(self):x}.npz')
+            write_columnar(self._data, fn)
+            self._spill = (self.path, fn)
+        self._data = {}
+        self._cache.clear() # computed from the data, kept within the budget too
+        self._derived_values.clear()
+        self._index = None # holds its own copy of the results
+
+    async def aload(self, executor=None, semaphore=None):
+        ''' Async counterpart of the <data> property, e.g. data = await metro_obj.aload()
+        The GDX file is parsed in executor (default: the event loop's executor), so the
+        event loop is not blocked. Concurrent loads of the same file are shared.
+        semaphore: optional asyncio.Semaphore limiting the number of parses in flight
+        Unlike <data>, a file that cannot be read raises gdxpds.Error instead of exiting
+        With a store attached (see attach_store()) nothing is loaded: the results table
+        is not rebuilt from the store, and only the other tables are returned
+        '''
+        if self._store is not None:
+            return self._data # results read from the store when needed
+        if self._data:
+            return self.data #data already read, return directly
+
+        if self._has_spill():
+            loop = asyncio.get_running_loop() # reload evicted data from columnar copy
+            return await loop.run_in_executor(executor, getattr, self, 'data')
+
+        try:
+            data = await _aread_gdx(self.path, executor, semaphore)
         except gdxpds.Error as msg:
             print(f'{msg} \n'
                   f'Please use metro_obj.path = <full path to gdx file containing METRO results>\n')
-
-            sys.exit()
-
+            raise
+
+        if not self._data: # may have been loaded by a concurrent caller meanwhile
+            self._data = dict(data) # own dict, the dataframes are shared
+            self._data['results'] = self._cast(self._data['results'])
+            self._invalidate()
+        if self._budget is not None:
+            self._budget.touch(self)
         return self._data
 
     @property
@@ -132,17 +304,21 @@ class metro_data(object):
         Example to get the list of variables
                     metro_data_object.dimensions[ 'variables']
         '''
-        res= self.data['results']
+        if self._store is not None:
+            unique = self._store.uniques
+        else:
+            res= self.data['results']
+            unique = lambda col: list(pd.unique(res[col]))
 
-        rregions = list(pd.unique(res['dim1']))
+        rregions = unique('dim1')
         if 'empty'in rregions: rregions.remove('empty')
-        wregions = [s for s in pd.unique(res['dim2']) if s[0]=='w']
-        factors = [s for s in pd.unique(res['dim2']) if s[0]=='f']
-        variables = list(pd.unique(res['variable']))
-        commodities = [s for s in pd.unique(res['dim4']) if s[0]=='c']
-        activities = [s for s in pd.unique(res['dim4']) if s[0]=='a']
-        usecat = [s for s in pd.unique(res[ 'dim5']) if s[0]=='u']
-        otherdims = [s for s in pd.unique(res['dim5']) if s not in usecat]
+        wregions = [s for s in unique('dim2') if s[0]=='w']
+        factors = [s for s in unique('dim2') if s[0]=='f']
+        variables = unique('variable')
+        commodities = [s for s in unique('dim4') if s[0]=='c']
+        activities = [s for s in unique('dim4') if s[0]=='a']
+        usecat = [s for s in unique( 'dim5') if s[0]=='u']
+        otherdims = [s for s in unique('dim5') if s not in usecat]
         otherdims.remove('empty')
 
         return {'variables':variables, \
@@ -169,19 +345,249 @@ class metro_data(object):
         ''' returns a dict of dataframes by variable '''
         return dict(list(self.data['results'].groupby(['variable'])))
 
+    def _variable_rows(self, v):
+        ''' returns the rows of the results table for variable v '''
+        if self._index is not None:
+            return self._index.rows(v)
+        if self._store is not None:
+            return self._store.variable_rows(v)
+        res = self.data['results']
+        return res[res['variable'] == v]
+
+    def build_index(self):
+        ''' Builds a sorted index of the results on (variable, dim1, dim2, dim4, dim5),
+        see keyspace.sorted_index. get_variable() and get_rows() then find the rows of
+        a variable by binary search instead of scanning the results table.
+        The index is dropped with the data when evicted by a stack budget. '''
+        self._index = sorted_index(self.data['results'])
+
+    def get_rows(self, v, **dims):
+        ''' Returns the rows of the results table of variable v matching dims
+        {dim: label}, e.g. metro_obj.get_rows('QER', dim1='r0', dim2='w1')
+        Uses the sorted index if built (see build_index()), the fastest when dims are
+        leading dims in the order dim1, dim2, dim4, dim5 '''
+        if self._index is not None:
+            return self._index.rows(v, **dims)
+        rows = self._variable_rows(v)
+        for d, label in dims.items():
+            rows = rows[rows[d] == label]
+        return rows.reset_index(drop=True)
+
     def get_variable(self, v):
-        '''returns values of one variable '''
-        dims=['dim1', 'dim2','dim4','dim5']
-        try:
-            tmp = self._variables[v]
-            for c in tmp.columns: # remove columns that only have 'empty' as value
-                if (tmp[c] == 'empty').all():
-                   dims.remove(c)
+        '''returns values of one variable, native or derived (see define()) '''
+        if v in self._derived:
+            try:
+                value = self._evaluate(v)
+            except KeyError as msg:
+                print(msg.args[0])
+                return None
+            return value.copy() if hasattr(value, 'copy') else value
+        value = self._cached_pivot(v)
+        return None if value is None else value.copy() # the cached frame stays intact
+
+    def _cached_pivot(self, v):
+        ''' returns _pivot(v) from the cache if possible, otherwise computes and caches it
+        Callers must not change the returned frame '''
+        key = (v, self._precision.name)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self._cache_stats['hits'] += 1
+            return self._cache[key][0]
+
+        self._cache_stats['misses'] += 1
+        value = self._pivot(v)
+        if value is not None:
+            nbytes = _nbytes(value)
+            if nbytes <= self.cache_max_bytes:
+                self._cache[key] = (value, nbytes)
+                self._shrink_cache()
+        return value
+
+    def _cache_bytes(self):
+        ''' returns the bytes held by the cache and the memoized derived values '''
+        return sum(b for _, b in self._cache.values()) + \
+            sum(b for _, b in self._derived_values.values())
+
+    def _shrink_cache(self):
+        ''' evicts least recently used cache entries, then the oldest memoized derived
+        values, until both together are within budget '''
+        nbytes = self._cache_bytes()
+        while self._cache and nbytes > self.cache_max_bytes:
+            _, (_, b) = self._cache.popitem(last=False)
+            nbytes -= b
+            self._cache_stats['evictions'] += 1
+        while self._derived_values and nbytes > self.cache_max_bytes:
+            b = self._derived_values.pop(next(iter(self._derived_values)))[1]
+            nbytes -= b
+            self._cache_stats['evictions'] += 1
+
+    def set_cache(self, max_bytes):
+        ''' Sets the byte budget of the cache of get_variable() outputs and the memoized
+        derived variables (see define()), 0 disables both
+        get_variable() returns copies of cached outputs, so callers can change them '''
+        self.cache_max_bytes = max_bytes
+        self._shrink_cache()
+
+    def cache_info(self):
+        ''' Returns a dict with the hits, misses, evictions, entries and bytes of the cache
+        of get_variable() outputs, the bytes including the memoized derived variables '''
+        return {**self._cache_stats, 'entries': len(self._cache),
+                'derived_entries': len(self._derived_values),
+                'bytes': self._cache_bytes(),
+                'max_bytes': self.cache_max_bytes}
 
-            return tmp.groupby(dims).sum().unstack()
+    @property
+    def precision(self):
+        ''' numpy dtype of the values of the results and of get_variable() outputs '''
+        return self._precision
+
+    def set_precision(self, dtype):
+        ''' Sets the precision of the values to np.float64 (default) or np.float32
+        The results table is converted when loaded (or now, if already loaded) and
+        get_variable() outputs, derived variables, mappings and pct_diff() keep the
+        precision. float32 halves the memory of the values at about 7 significant digits.
+        Sums over rows are computed in float64 and rounded once, so with float32:
+        - values and get_variable() outputs have a relative error below 6e-8
+        - get_total() (float64) has an error below 6e-8 * the sum of absolute values
+        - pct_diff() has an error below 2e-5 * (1 + pct/100) percentage points
+        Going back to a higher precision reloads the data from the file, also when the
+        results were compressed (see result_stack.compress()) in the lower precision.
+        '''
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError(f'* ERROR * precision must be float32 or float64, not {dtype}')
+        if dtype == self._precision:
+            return
+        if self._precision.itemsize < dtype.itemsize: # precision lost, reload the file
+            compressed = isinstance(self._store, (keyed_store, delta_store))
+            if 'results' in self._data or compressed:
+                self._data = {}
+                if compressed:
+                    self._store = None
+                if self._budget is not None:
+                    self._budget.forget(self)
+            self._spill = None # written in the lower precision
+        self._precision = dtype
+        if 'results' in self._data:
+            self._data['results'] = self._cast(self._data['results'])
+        self._derived_values.clear()
+        self._rollup = None
+        self._index = None
+
+    def _cast(self, results):
+        ''' returns results with its value column in the precision of the object
+        (results itself if it already is) '''
+        if results['value'].dtype == self._precision:
+            return results
+        return results.assign(value=results['value'].astype(self._precision))
+
+    def _pivot(self, v):
+        ''' returns the values of native variable v, summed over and unstacked by its used
+        dimensions; None if v is not in the results '''
+        dims=['dim1', 'dim2','dim4','dim5']
+        tmp = self._variable_rows(v)
+        if tmp.empty:
+            print(f'* ERROR * There is no variable "{v}" in the results file')
+            return None
+
+        for c in dims[:]: # remove columns that only have 'empty' as value
+            if (tmp[c] == 'empty').all():
+                dims.remove(c)
+
+        tmp = tmp.assign(value=tmp['value'].astype(np.float64)) # sum in double precision
+        return tmp.groupby(dims)[['value']].sum().unstack().astype(self._precision)
+
+    def define(self, name, expr, deps=None):
+        ''' Defines a derived variable name, computed from other (native or derived)
+        variables, e.g. metro_obj.define('TBAL', 'rEXPORT - rIMPORT')
+        expr: expression string or function of variables, see derived.derived_variable
+        deps: optional list of the variables expr depends on
+        The variable is computed when requested with get_variable(name) and memoized,
+        its native inputs are cached, so inputs shared by several derived variables are
+        only extracted once, as long as they fit in the cache (see set_cache()).
+        Redefining a variable drops the memoized values depending on it.
+        '''
+        self._derived[name] = derived_variable(name, expr, deps)
+        stale = {name}
+        while True: # add the derived variables depending on stale ones
+            more = {n for n, d in self._derived.items() if stale & set(d.deps)} - stale
+            if not more:
+                break
+            stale |= more
+        for n in stale:
+            self._derived_values.pop(n, None)
+
+    def _evaluate(self, v, active=()):
+        ''' returns the memoized value of variable v, evaluating the derived variables
+        it depends on first. active: the derived variables being evaluated '''
+        if v in self._derived_values:
+            return self._derived_values[v][0]
+        if v in active:
+            raise KeyError(f'* ERROR * Circular definition of derived variable "{v}"')
+
+        if v not in self._derived: # native input, from the cache
+            value = self._cached_pivot(v)
+            if value is None:
+                raise KeyError(f'* ERROR * Derived variable "{active[-1]}" needs "{v}"')
+            return value
+        d = self._derived[v]
+        value = d.evaluate({dep: self._evaluate(dep, active + (v,)) for dep in d.deps})
+        nbytes = _nbytes(value)
+        if nbytes <= self.cache_max_bytes:
+            self._derived_values[v] = (value, nbytes)
+            self._shrink_cache()
+        return value
+
+    def build_rollup(self, variables=None):
+        ''' Builds a rollup cube with the sums of variables (default: all) over every
+        subset of their used dimensions. get_total() then serves those sums from the
+        cube instead of summing the results again.
+        '''
+        self._rollup = rollup_cube(self.data['results'], variables)
+
+    def get_total(self, v, by=()):
+        ''' Returns the sum of variable v over all its dimensions not in by
+        by: dimensions to keep, e.g. () for the world total, ('dim1',) for region
+            totals over commodities, ('dim4',) for commodity totals over regions
+        Returns a Series indexed by the used dimensions in by, or a float if by is empty
+        Uses the rollup cube if v is in it (see build_rollup())
+        '''
+        if self._rollup is not None and v in self._rollup:
+            return self._rollup.get(v, by)
 
-        except KeyError:
+        rows = self._variable_rows(v)
+        if rows.empty:
             print(f'* ERROR * There is no variable "{v}" in the results file')
+            return None
+        return aggregate(rows, by)
+
+    def to_arrow(self, v=None):
+        ''' Returns the results table (v=None) or the get_variable(v) output as a
+        pyarrow Table with dictionary-encoded dimensions, see arrowtools '''
+        if v is None:
+            return arrowtools.results_to_arrow(self.data['results'])
+        df = self.get_variable(v)
+        return None if df is None else arrowtools.frame_to_arrow(df)
+
+    def memory_usage(self):
+        ''' returns the approximate memory in bytes held by the loaded data '''
+        nbytes = sum(df.memory_usage(deep=True).sum() for df in self._data.values()
+                     if isinstance(df, pd.DataFrame))
+        if self._store is not None:
+            nbytes += self._store.nbytes
+        if self._index is not None:
+            nbytes += self._index.nbytes
+        return int(nbytes)
+
+    async def aget_variable(self, v, executor=None, semaphore=None):
+        ''' Async counterpart of get_variable(v), e.g. df = await metro_obj.aget_variable(v)
+        Loads the file with aload() if necessary and extracts the variable in executor
+        With a store attached, the variable is read from the store in executor
+        '''
+        if self._store is None:
+            await self.aload(executor, semaphore)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.get_variable, v)
 
     def __str__(self):
         s = str(self.fullname).strip("{" "}")
@@ -190,15 +596,99 @@ class metro_data(object):
 
 #end class metro_data()
 
+class _memory_budget(object):
+    ''' Keeps the loaded metro_data objects of a result_stack within a memory budget
+    Objects are kept in least-recently-used order. When the budget is exceeded, the
+    least recently used ones drop their data, which is reloaded from a columnar copy
+    in spill_dir the next time it is needed.
+    '''
+    def __init__(self, max_bytes=None, max_scenarios=None, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.max_scenarios = max_scenarios
+        if spill_dir is None:
+            spill_dir = tempfile.mkdtemp(prefix='metro_spill_')
+            weakref.finalize(self, shutil.rmtree, spill_dir, ignore_errors=True)
+        self.spill_dir = spill_dir
+        self.evictions = 0
+        self.reloads = 0
+        self._loaded = OrderedDict() # id(metro_obj): (metro_obj, bytes)
+
+    @property
+    def nbytes(self):
+        return sum(b for _, b in self._loaded.values())
+
+    def touch(self, metro_obj):
+        ''' Marks metro_obj as most recently used and evicts others if over budget '''
+        key = id(metro_obj)
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+            return
+        self._loaded[key] = (metro_obj, metro_obj.memory_usage())
+
+        while len(self._loaded) > 1 and self._over_budget():
+            _, (lru, _) = self._loaded.popitem(last=False)
+            lru._evict(self.spill_dir)
+            self.evictions += 1
+
+    def forget(self, metro_obj):
+        ''' Removes metro_obj from the bookkeeping, without evicting it '''
+        self._loaded.pop(id(metro_obj), None)
+
+    def _over_budget(self):
+        if self.max_scenarios is not None and len(self._loaded) > self.max_scenarios:
+            return True
+        return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+#end class _memory_budget
+
 class result_stack(object):
     ''' Class containing stack of metro_data objects
     '''
     def __init__(self):
         self.stack = []
+        self._budget = None
+        self.matrix = None # keyspace.scenario_matrix, see build_matrix()
+        self._derived = {} # name: (expr, deps) of derived variables, see define()
+        self._precision = None # dtype of the values, see set_precision()
 
     def add_result(self, metro_obj):
         ''' Adds metro_data object to stack'''
         self.stack.append(metro_obj)
+        if self._precision is not None:
+            metro_obj.set_precision(self._precision)
+        for name, (expr, deps) in self._derived.items():
+            metro_obj.define(name, expr, deps)
+        if self._budget is not None:
+            metro_obj._budget = self._budget
+            if metro_obj._data:
+                self._budget.touch(metro_obj)
+
+    def set_budget(self, max_bytes=None, max_scenarios=None, spill_dir=None):
+        ''' Limits the memory held by the loaded results in the stack
+        max_bytes: maximum bytes of loaded data (as metro_data.memory_usage())
+        max_scenarios: maximum number of loaded metro_data objects
+        spill_dir: directory for the columnar copies of evicted data, default is a
+                   temporary directory removed when the budget is discarded
+        When the budget is exceeded, the least recently used metro_data objects drop
+        their data and reload it on demand from the columnar copy.
+        Use set_budget() without arguments to remove the budget.
+        '''
+        if max_bytes is None and max_scenarios is None:
+            budget = None
+        else:
+            budget = _memory_budget(max_bytes, max_scenarios, spill_dir)
+        self._budget = budget
+        for k in self.stack:
+            k._budget = budget
+            if budget is not None and k._data:
+                budget.touch(k)
+
+    def budget_stats(self):
+        ''' Returns a dict with eviction and reload counts of the memory budget '''
+        if self._budget is None:
+            return {}
+        return {'evictions': self._budget.evictions, 'reloads': self._budget.reloads,
+                'loaded': len(self._budget._loaded), 'bytes': self._budget.nbytes}
 
     def get_results(self):
         '''Returns a list of metro_data objects in stack'''
@@ -213,6 +703,96 @@ class result_stack(object):
         return [s.fullname for s in self.stack]
 
 
+    def compress(self, reference=None):
+        ''' Stores the results of the stack as sparse deltas over a reference scenario
+        All results are aligned on one key_space. The reference keeps its values on the
+        key space, every other scenario only keeps the cells that differ from it.
+        get_variable(), get_var() and the data property rebuild full values on request.
+        reference: dataID of the reference scenario, default is the first in stack
+        NOTE: loads all results files that are not loaded yet
+        '''
+        if reference is None:
+            ref = self.stack[0]
+        else:
+            ref = self.stack[self.get_dataIDs().index(reference)]
+
+        self.uncompress()
+        frames = [k.data['results'] for k in self.stack]
+        keys = key_space(frames)
+        ref_store = keyed_store(keys, frames[self.stack.index(ref)])
+        for k, f in zip(self.stack, frames):
+            k._store = ref_store if k is ref else delta_store(ref_store, f)
+            k._data.pop('results', None)
+            if self._budget is not None:
+                self._budget.forget(k)
+
+    def uncompress(self):
+        ''' Restores complete results tables after compress() '''
+        for k in self.stack:
+            if isinstance(k._store, (keyed_store, delta_store)):
+                k._data['results'] = k._store.results()
+                k._store = None
+
+    def build_matrix(self):
+        ''' Aligns all results in stack on one key_space and returns a
+        keyspace.scenario_matrix with their values in one keys x scenarios array,
+        for cross-scenario arithmetic (pct_diff, ratios, ranks, ensemble statistics)
+        without repeated index alignment. The matrix is also kept in self.matrix.
+        A compressed stack (see compress()) reuses its key space.
+        '''
+        stores = [k._store for k in self.stack]
+        if stores and all(isinstance(s, (keyed_store, delta_store)) for s in stores):
+            keys = (s if isinstance(s, keyed_store) else s.reference for s in stores)
+            keys = {id(s.keys): s.keys for s in keys}
+        else:
+            keys = {}
+
+        if len(keys) == 1: # compressed, all on the same key space
+            keys = list(keys.values())[0]
+            columns = [s.aligned() for s in stores]
+        else:
+            frames = [k.data['results'] for k in self.stack]
+            keys = key_space(frames)
+            columns = [keys.align(f, self._precision or np.float64)[0] for f in frames]
+
+        values = np.empty((len(keys), len(columns)), dtype=self._precision or np.float64)
+        for i, c in enumerate(columns):
+            values[:, i] = c
+        self.matrix = scenario_matrix(keys, values, self.get_dataIDs())
+        return self.matrix
+
+    def memory_usage(self):
+        ''' returns the approximate memory in bytes held by the stack '''
+        nbytes = sum(k.memory_usage() for k in self.stack)
+        stores = {id(k._store): k._store for k in self.stack if k._store is not None}
+        keys = {id(s.keys): s.keys for s in stores.values() if isinstance(s, keyed_store)}
+        return nbytes + sum(s.nbytes for s in keys.values())
+
+    def define(self, name, expr, deps=None):
+        ''' Defines derived variable name on all metro_data objects in stack, and on
+        those added later, see metro_data.define() '''
+        self._derived[name] = (expr, deps)
+        for k in self.stack:
+            k.define(name, expr, deps)
+
+    def set_precision(self, dtype):
+        ''' Sets the precision of the values (np.float64 or np.float32) of all metro_data
+        objects in stack and those added later, see metro_data.set_precision()
+        build_matrix() also makes its matrix in this precision '''
+        self._precision = np.dtype(dtype)
+        for k in self.stack:
+            k.set_precision(dtype)
+
+    def set_cache(self, max_bytes):
+        ''' Sets the byte budget of the get_variable() cache of every metro_data object
+        in stack, see metro_data.set_cache() '''
+        for k in self.stack:
+            k.set_cache(max_bytes)
+
+    def cache_info(self):
+        ''' Returns a dict {dataID: metro_data.cache_info()} '''
+        return {k.dataID: k.cache_info() for k in self.stack}
+
     def get_var(self, v):
         ''' Gets one variable from all metro_data objects in stack
         To find out which metro results are in stack use:
@@ -222,33 +802,211 @@ class result_stack(object):
             df_dict[k.dataID]= k.get_variable(v)
         return df_dict
 
+    def to_arrow(self, v=None):
+        ''' Returns the results rows (v=None) or the rows of variable v of all metro_data
+        objects in stack as one pyarrow Table, with a 'dataID' column and one record
+        batch per metro_data object. Write it with arrowtools.write_ipc() '''
+        tables = []
+        for k in self.stack:
+            rows = k.data['results'] if v is None else k._variable_rows(v)
+            tables.append(arrowtools.results_to_arrow(rows, dataID=k.dataID))
+        return arrowtools.pa.concat_tables(tables)
+
+    def to_batches(self, v=None):
+        ''' Returns to_arrow(v) as a list of pyarrow RecordBatches '''
+        return self.to_arrow(v).to_batches()
+
+    def build_rollup(self, variables=None):
+        ''' Builds rollup cubes for all metro_data objects in stack, see metro_data.build_rollup() '''
+        for k in self.stack:
+            k.build_rollup(variables)
+
+    def build_index(self):
+        ''' Builds the sorted index of all metro_data objects in stack, see metro_data.build_index() '''
+        for k in self.stack:
+            k.build_index()
+
+    def get_total(self, v, by=()):
+        ''' Gets the sums of variable v over the dimensions not in by from all metro_data
+        objects in stack, as a dict like get_var() '''
+        return {k.dataID: k.get_total(v, by) for k in self.stack}
+
+    async def aload(self, max_concurrent=4, executor=None, progress=None):
+        ''' Loads all metro_data objects in stack concurrently, e.g. await stack.aload()
+        max_concurrent: maximum number of GDX files parsed at the same time, None for no limit
+        executor: concurrent.futures executor for parsing, default is the event loop's executor
+        progress: optional callable progress(n_done, n_total, metro_obj), called each time a
+                  file has been loaded
+        Returns the list of metro_data objects in stack
+        '''
+        semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+        n_total = len(self.stack)
+        n_done = 0
+
+        async def load_one(metro_obj):
+            nonlocal n_done
+            await metro_obj.aload(executor, semaphore)
+            n_done += 1
+            if progress is not None:
+                progress(n_done, n_total, metro_obj)
+
+        await asyncio.gather(*(load_one(k) for k in self.stack))
+        return self.get_results()
+
+    async def aget_var(self, v, max_concurrent=4, executor=None):
+        ''' Async counterpart of get_var(v), e.g. df_dict = await stack.aget_var(v) '''
+        await self.aload(max_concurrent, executor)
+        frames = await asyncio.gather(*(k.aget_variable(v, executor) for k in self.stack))
+        return dict(zip(self.get_dataIDs(), frames))
+
     def __str__(self):
         pass # nothing to print by default
 
 #end class result_stack
 
 #%% Helper functions for dataframes and series
-def add_ctotal(df, name='TOTAL'):
-    '''Adds column totals to dataframe or series df
-    NOTE: the df.append method alters the index of the df '''
-    c_total=[]
-    if is_series(df):
-        c_total = pd.Series(df.sum(), index=[name])
-        return df.append(c_total)
+def add_margins(df, name='TOTAL', rtotal=True, ctotal=True, subtotals=False):
+    '''Adds row totals, column totals and subtotals per index level to dataframe or
+    series df in one pass
+    df: dataframe or series (a series gets no row totals)
+    name: label of the added rows and column
+    rtotal: if True, adds a column with the sum over the numeric columns of each row
+    ctotal: if True, adds a row with the sum over all rows of each column
+    subtotals: if True and df has a row multi-index, adds a subtotal row after each
+               group of rows at every index level but the last. Groups are in order
+               of first appearance within the group of the level above.
+    Added rows are labelled (..., name, '', ...) in a multi-index, non-numeric columns
+    are left empty ('') in the added rows. NaN counts as 0 in the sums. Numeric columns
+    keep their dtype (bool columns become int counts).
+    Returns a new dataframe or series, df is not changed
+    '''
+    series = is_series(df)
+    frame = df.to_frame() if series else df
+    rtotal = rtotal and not series
+    n = len(frame)
+    n_levels = frame.index.nlevels
+
+    numeric = np.array([pd.api.types.is_numeric_dtype(t) for t in frame.dtypes], dtype=bool)
+    arrays = [frame.iloc[:, i].to_numpy() for i in np.flatnonzero(numeric)]
+    arrays = [a.astype(np.int64) if a.dtype == bool else a for a in arrays] # sums are counts
+    blocks = {} # dtype: numbers of the numeric columns of that dtype, summed in it
+    for j, a in enumerate(arrays):
+        blocks.setdefault(a.dtype, []).append(j)
+    if not blocks:
+        blocks[np.dtype(np.float64)] = []
+    single = len(blocks) == 1 # one block, the row totals in the same array
+
+    # sort rows into groups and number the groups at every index level but the last
+    group, starts = [], []
+    if subtotals and n_levels > 1 and n > 0:
+        codes, key = [], np.zeros(n, dtype=np.int64)
+        for l in range(n_levels - 1): # groups in order of first appearance in their group
+            level = pd.factorize(frame.index.get_level_values(l), use_na_sentinel=False)[0]
+            key = pd.factorize(key * (level.max() + 1) + level)[0]
+            codes.append(key)
+        order = np.lexsort(codes[::-1])
+        changed = np.zeros(n, dtype=bool)
+        for c in codes:
+            c = c[order]
+            changed[1:] |= c[1:] != c[:-1]
+            group.append(np.cumsum(changed))
+            starts.append(np.flatnonzero(np.r_[True, changed[1:]]))
     else:
-        c_total = pd.Series(df.sum(), index=df.columns, name=name)
+        order = np.arange(n)
+
+    # output positions: a subtotal row follows the last row of its group and the
+    # subtotals of deeper levels of that group
+    n_out = n + sum(len(s) for s in starts) + (1 if ctotal else 0)
+    row_pos = np.arange(n) + sum(group)
+    sub_pos = []
+    for k, s in enumerate(starts):
+        last = np.r_[s[1:], n] - 1
+        sub_pos.append(last + 1 + sum(g[last] for g in group) + len(group) - 1 - k)
+
+    # numeric blocks, allocated once per dtype
+    out_cols = [None] * len(arrays)
+    for dtype, js in blocks.items():
+        values = np.column_stack([arrays[j] for j in js]) if js else np.empty((n, 0), dtype)
+        filled = np.where(np.isnan(values), 0, values) if dtype.kind == 'f' else values
+        n_num = len(js)
+        out = np.empty((n_out, n_num + (rtotal and single)), dtype=dtype)
+        out[row_pos, :n_num] = values[order]
+        sorted_filled = filled[order]
+        for pos, s in zip(sub_pos, starts):
+            out[pos, :n_num] = np.add.reduceat(sorted_filled, s, axis=0)
+        if ctotal:
+            out[-1, :n_num] = filled.sum(axis=0)
+        for k, j in enumerate(js):
+            out_cols[j] = out[:, k]
+    if rtotal and single:
+        out[:, n_num] = np.nansum(out[:, :n_num], axis=1)
+        row_total = out[:, n_num]
+    elif rtotal: # in the common dtype of the columns, like DataFrame.sum(axis=1)
+        row_total = np.zeros(n_out, dtype=np.result_type(*blocks))
+        for c in out_cols:
+            row_total += np.where(np.isnan(c), 0, c) if c.dtype.kind == 'f' else c
+
+    # row labels
+    if n_levels > 1:
+        level_values = [frame.index.get_level_values(l).to_numpy()[order] for l in range(n_levels)]
+        arrays = [np.empty(n_out, dtype=object) for _ in range(n_levels)]
+        for l in range(n_levels):
+            arrays[l][row_pos] = level_values[l]
+            for k, (pos, s) in enumerate(zip(sub_pos, starts)):
+                arrays[l][pos] = level_values[l][s] if l <= k else (name if l == k + 1 else '')
+            if ctotal:
+                arrays[l][-1] = name if l == 0 else ''
+        index = pd.MultiIndex.from_arrays(arrays, names=frame.index.names)
+    else:
+        labels = np.empty(n_out, dtype=object)
+        labels[:n] = frame.index.to_numpy()
+        if ctotal:
+            labels[-1] = name
+        index = pd.Index(labels, name=frame.index.name)
+
+    # column labels
+    columns = list(frame.columns)
+    if rtotal:
+        columns.append(name if frame.columns.nlevels == 1 else
+                       (name,) + ('',) * (frame.columns.nlevels - 1))
+    if frame.columns.nlevels > 1:
+        columns = pd.MultiIndex.from_tuples(columns, names=frame.columns.names)
+    else:
+        columns = pd.Index(columns, name=frame.columns.name)
+
+    if numeric.all() and single:
+        res = pd.DataFrame(out, index=index, columns=columns, copy=False)
+    else: # non-numeric columns keep their values, empty in the added rows
+        cols, j = {}, 0
+        for i, is_num in enumerate(numeric):
+            if is_num:
+                cols[i] = out_cols[j]
+                j += 1
+            else:
+                col = np.full(n_out, '', dtype=object)
+                col[row_pos] = frame.iloc[:, i].to_numpy()[order]
+                cols[i] = col
+        if rtotal:
+            cols[len(numeric)] = row_total
+        res = pd.DataFrame(cols, index=index)
+        res.columns = columns
+
+    if series:
+        res = res.iloc[:, 0].rename(df.name)
+    return res
+#end def add_margins
 
-    return df.append(c_total)
+def add_ctotal(df, name='TOTAL'):
+    '''Adds column totals to dataframe or series df
+    Returns a new dataframe or series, see add_margins() '''
+    return add_margins(df, name, rtotal=False, ctotal=True)
 
 
 def add_rtotal(df, name='TOTAL'):
     '''Adds row totals to dataframe df
-    If df is a Series it adds a column total'''
-    if is_series(df):
-        return add_ctotal(df, name)
-    else:
-        df[name] = df.sum(axis=1)
-        return df
+    If df is a Series it adds a column total
+    Returns a new dataframe or series, see add_margins() '''
+    return add_margins(df, name, rtotal=not is_series(df), ctotal=is_series(df))
 
 def add_mapper(df, col, mapper):
     ''' Adds a column to dataframe df to map col into a new list
@@ -277,8 +1035,9 @@ def add_mapper(df, col, mapper):
 def pct_diff(df1, df2):
     ''' Returns percent difference between df1 and df2 for all valid columns
     Accepts Pandas series and Pandas dataframes
-    Ignores nun-numeric columns, i.e. not 'float64' or 'int64'
-    Returns a dataframe: (df2/df1 -1)*100
+    Ignores nun-numeric columns, i.e. not 'float64', 'float32' or 'int64'
+    Returns a dataframe: (df2/df1 -1)*100, computed in float64 and returned in
+    float32 if all columns of df1 and df2 are float32
     '''
     # convert series to df if necessary:
     if is_series(df1):
@@ -292,13 +1051,16 @@ def pct_diff(df1, df2):
     # check if columns have non-numerical values and drop if necessary:
     to_drop=[]
     for c in range(len(df1.columns)):
-        if df1.iloc[:,c].dtypes not in ['float64', 'int64']:   #not a valid data type
+        if df1.iloc[:,c].dtypes not in ['float64', 'float32', 'int64']:   #not a valid data type
             to_drop.append(c)
 
     d1=df1.drop(df1.columns[(to_drop)], axis = 1, inplace=False)
     d2=df2.drop(df2.columns[(to_drop)], axis = 1, inplace=False)
 
-    return (d2 / d1 -1.0)*100
+    res = (d2.astype(np.float64) / d1.astype(np.float64) -1.0)*100
+    if (d1.dtypes == np.float32).all() and (d2.dtypes == np.float32).all():
+        res = res.astype(np.float32)
+    return res
 #end def pct_change
 
 def pct_diff_list(base_df, df_list, headers=[" "], basecol= False):
@@ -346,7 +1108,7 @@ def pct_diff_list(base_df, df_list, headers=[" "], basecol= False):
 
 def is_series(df):
     '''returns True if df is type pandasSeries '''
-    return str(type(df)) == "<class 'pandas.core.series.Series'>"
+    return isinstance(df, pd.Series)
 #end def is_series()
 
 #standard macro table
@@ -371,7 +1133,7 @@ def macro_table(M_data, longnames=False):
                  'rEXPORT' : 'Exports',
                  'rIMPORT' : 'Imports' }
 
-    df_tmp=pd.DataFrame(columns=['rregion','value', 'variable', 'var_descript'])
+    frames=[]
 
     for v in variables.keys():
         var= M_data.get_variable(v)
@@ -380,16 +1142,17 @@ def macro_table(M_data, longnames=False):
         df.reset_index(inplace=True)
         df.drop(columns='level_0', inplace=True)
         df.rename(columns={'dim1': 'rregion'}, inplace=True)
-        df_tmp=df_tmp.append(df, sort=False)
+        frames.append(df)
+    df_tmp=pd.concat(frames, sort=False)
 
     if longnames:
         df_tmp['reg_longname']= df_tmp['rregion'].map(M_data.get_set('rregions'))
         df_tmp['var_descript'] = df_tmp['variable'].map(variables)
         df_out=df_tmp.groupby(by=['var_descript','variable', 'reg_longname'], \
-                          sort=False).sum().unstack('reg_longname')
+                          sort=False)[['value']].sum().unstack('reg_longname')
     else:
         df_out=df_tmp.groupby(by=['variable', 'rregion'], \
-                          sort=False).sum().unstack('rregion')
+                          sort=False)[['value']].sum().unstack('rregion')
 
     df_out = add_rtotal(df_out)
 
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+panel - the results of recursive-dynamic METRO runs, one GDX file per scenario and
+year, as one (keys x scenarios x years) panel
+
+The files are loaded concurrently and aligned on one keyspace.key_space, with year as
+a coded axis of the value array. Growth rates, cumulative changes and year-on-year or
+cross-scenario percent differences are computed along the axes of the whole panel.
+
+Example:
+    files = panel.panel_files('data/{scenario}_{year}.gdx', ['base', 'fta'], range(2020, 2031))
+    p = panel.result_panel(files)
+    p.load(max_concurrent=8)
+    p.get_variable('rGDPEXP')              # years in rows, (scenario, region) in columns
+    p.growth('rGDPEXP')                    # annual growth rates in %
+    p.cumulative('rGDPEXP', base_year=2020) # % change since 2020
+    p.pct_diff('base', v='rGDPEXP')        # % difference with the base scenario, per year
+
+@author: VanTongeren_F
+"""
+# standard library imports
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from metro import metropy
+from metro.keyspace import key_space
+
+def _run(coro):
+    ''' runs coroutine coro to completion and returns its result, in a new event loop
+    in a thread if this thread already runs one (e.g. in Jupyter or an IPython console) '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError: # no event loop running
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as thread:
+        return thread.submit(asyncio.run, coro).result()
+
+def panel_files(pattern, scenarios, years)-> dict:
+    ''' returns {(scenario, year): path} for all scenarios and years, the paths made
+    from pattern, e.g. 'data/{scenario}_{year}.gdx' '''
+    return {(s, y): pattern.format(scenario=s, year=y) for s in scenarios for y in years}
+
+class result_panel(object):
+    '''
+    A (scenario x year) grid of METRO results files
+
+    files:   dict {(scenario, year): path to the results file of that scenario and year}
+             Scenarios keep their order of appearance, years are sorted.
+    setpath: path of the sets file, for all metro_data objects
+
+    stack:   a metropy.result_stack with a metro_data object per file, dataID
+             '<scenario>_<year>'
+    values:  after load(), the keys x scenarios x years float array, NaN where a file
+             has no value for a key
+    keys:    after load(), the keyspace.key_space of the rows of values
+
+    Every method takes an optional variable v: without it, the result is a NumPy array
+    over all keys; with it, only the rows of v are computed and returned as a dataframe
+    with the years as index and (scenario, used dimensions of v) as columns.
+    '''
+    def __init__(self, files, setpath=' '):
+        self.scenarios = list(dict.fromkeys(s for s, _ in files))
+        self.years = sorted(set(y for _, y in files))
+        self.stack = metropy.result_stack()
+        self._cells = {} # (scenario position, year position): metro_data
+        for (s, y), path in files.items():
+            m = metropy.metro_data(f'{s}_{y}')
+            m.path = path
+            m.setpath = setpath
+            m.legend = f'{s} {y}'
+            self.stack.add_result(m)
+            self._cells[(self.scenarios.index(s), self.years.index(y))] = m
+        self.keys = None
+        self.values = None
+
+    async def aload(self, max_concurrent=4, executor=None, progress=None):
+        ''' Loads all files concurrently (see result_stack.aload()) and builds the panel
+        in a thread, so the event loop is not blocked '''
+        await self.stack.aload(max_concurrent, executor, progress)
+        await asyncio.get_running_loop().run_in_executor(None, self.build)
+
+    def load(self, max_concurrent=4, executor=None, progress=None):
+        ''' Loads all files concurrently and builds the panel, e.g. p.load(8)
+        executor: e.g. a concurrent.futures.ProcessPoolExecutor to parse in processes
+        Also works where an event loop is running, e.g. in Jupyter; there
+        await p.aload() does not block the loop '''
+        _run(self.aload(max_concurrent, executor, progress))
+
+    def build(self):
+        ''' Aligns the results of all files on one key space, in self.values
+        Loads the files that are not loaded yet, one by one '''
+        cells = list(self._cells.items())
+        frames = [m.data['results'] for _, m in cells]
+        self.keys = key_space(frames)
+        dtype = self.stack._precision or np.float64
+        self.values = np.full((len(self.keys), len(self.scenarios), len(self.years)),
+                              np.nan, dtype=dtype)
+        for ((i, j), _), f in zip(cells, frames):
+            self.values[:, i, j] = self.keys.align(f, dtype)[0]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.keys.nbytes
+
+    def _block(self, v):
+        ''' returns the rows of the panel for variable v (all rows if v is None) '''
+        if v is None:
+            return self.values
+        start, stop = self.keys.var_range(v)
+        return self.values[start:stop]
+
+    def _out(self, v, block):
+        ''' attaches labels to block (rows of v x scenarios x years), if v is given '''
+        if v is None:
+            return block
+        start, stop = self.keys.var_range(v)
+        rows = np.arange(start, stop)
+        labels = {d: self.keys.categories[d].to_numpy()[self.keys.codes[d][rows]]
+                  for d in ['dim1', 'dim2', 'dim4', 'dim5']}
+        used = [d for d in labels if not (labels[d] == 'empty').all()]
+        order = np.lexsort([labels[d] for d in reversed(used)])
+        block = block[order]
+
+        n_rows, n_scen = block.shape[0], block.shape[1]
+        columns = pd.MultiIndex.from_arrays(
+            [np.repeat(self.scenarios, n_rows)]
+            + [np.tile(labels[d][order], n_scen) for d in used],
+            names=['scenario'] + used)
+        data = block.transpose(2, 1, 0).reshape(len(self.years), -1)
+        return pd.DataFrame(data, index=pd.Index(self.years, name='year'), columns=columns)
+
+    def get_variable(self, v, as_array=False):
+        ''' returns the values of variable v over all scenarios and years, as a
+        dataframe or, with as_array=True, as a (keys of v x scenarios x years) array '''
+        block = self._block(v)
+        return block.copy() if as_array else self._out(v, block)
+
+    def _steps(self):
+        ''' returns the number of years between consecutive years '''
+        return np.diff(np.asarray(self.years, dtype=np.float64))
+
+    def yoy(self, v=None):
+        ''' returns the percent change from the previous year, (x[t]/x[t-1] - 1)*100
+        NaN for the first year '''
+        block = self._block(v)
+        res = np.full(block.shape, np.nan, dtype=block.dtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res[..., 1:] = (block[..., 1:] / block[..., :-1] - 1.0) * 100
+        return self._out(v, res)
+
+    def growth(self, v=None):
+        ''' returns the average annual growth rate in % since the previous year
+        in the panel, ((x[t]/x[t-1])**(1/(year[t]-year[t-1])) - 1)*100, so steps of
+        several years are annualized. NaN for the first year '''
+        block = self._block(v)
+        res = np.full(block.shape, np.nan, dtype=block.dtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res[..., 1:] = ((block[..., 1:] / block[..., :-1]) ** (1.0 / self._steps())
+                            - 1.0) * 100
+        return self._out(v, res)
+
+    def cumulative(self, v=None, base_year=None, pct=True):
+        ''' returns the cumulative change since base_year (default: the first year),
+        in percent (x[t]/x[base] - 1)*100, or as a difference x[t] - x[base] if not pct '''
+        block = self._block(v)
+        base = block[..., [self.years.index(base_year) if base_year is not None else 0]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = (block / base - 1.0) * 100 if pct else block - base
+        return self._out(v, res)
+
+    def pct_diff(self, base, v=None):
+        ''' returns the percent difference (x/x[base] - 1)*100 of every scenario with
+        scenario base, per year '''
+        block = self._block(v)
+        i = self.scenarios.index(base)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = (block / block[:, [i], :] - 1.0) * 100
+        return self._out(v, res)
+
+#end class result_panel
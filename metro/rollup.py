@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+rollup - materialized sums of METRO variables over subsets of their dimensions
+
+@author: VanTongeren_F
+"""
+import itertools
+
+import numpy as np
+
+DIMS = ['dim1', 'dim2', 'dim4', 'dim5'] # dimensions of a variable in the results table
+
+def used_dims(rows):
+    ''' returns the dimensions of a variable's rows that do not only contain 'empty' '''
+    return [d for d in DIMS if not (rows[d] == 'empty').all()]
+
+def aggregate(rows, by=()):
+    '''
+    Sums the rows of one variable over all its dimensions not in by
+
+    PARAMETERS
+    ----------
+    rows: the rows of the results dataframe for one variable
+    by:   the dimensions to keep, e.g. ('dim1',) for region totals
+
+    RETURNS
+    -------
+    a pandas Series indexed by the used dimensions in by, or a float if by is empty
+    Sums are computed in float64, also for float32 values
+    '''
+    keep = [d for d in by if d in used_dims(rows)]
+    values = rows['value'].astype(np.float64)
+    if not keep:
+        return values.sum()
+    return values.groupby([rows[d] for d in keep]).sum()
+#end aggregate()
+
+class rollup_cube(object):
+    '''
+    Sums of METRO variables over every subset of their used dimensions.
+    The cube is built in one pass: the results are summed once to the finest level
+    per variable, and every coarser subset is summed from its smallest parent.
+    '''
+    def __init__(self, results, variables=None):
+        if variables is not None:
+            results = results[results['variable'].isin(variables)]
+
+        self.used = {}
+        self.cells = {} # (variable, tuple of kept dims): Series, or float for ()
+        values = results['value'].astype(np.float64) # sums in double precision
+        finest = values.groupby([results[c] for c in ['variable'] + DIMS]).sum()
+        for v, block in finest.groupby(level='variable'):
+            block = block.droplevel('variable')
+            used = [d for d in DIMS if not
+                    (block.index.get_level_values(d) == 'empty').all()]
+            block = block.droplevel([d for d in DIMS if d not in used])
+            self.used[v] = used
+            self.cells[(v, tuple(used))] = block
+
+            for n in range(len(used) - 1, -1, -1):
+                for keep in itertools.combinations(used, n):
+                    self.cells[(v, keep)] = self._from_parent(v, keep, used)
+
+    def _from_parent(self, v, keep, used):
+        ''' sums the cell keep of variable v from its smallest parent in the cube'''
+        parents = [self.cells[(v, tuple(d for d in used if d in keep or d == extra))]
+                   for extra in used if extra not in keep]
+        parent = min(parents, key=len)
+        if not keep:
+            return parent.sum()
+        return parent.groupby(level=list(keep)).sum()
+
+    def __contains__(self, v):
+        return v in self.used
+
+    def get(self, v, by=()):
+        ''' returns the sums of variable v over all its dimensions not in by
+        as a Series indexed by the used dimensions in by, or a float if by is empty'''
+        keep = tuple(d for d in self.used[v] if d in by)
+        cell = self.cells[(v, keep)]
+        if not keep:
+            return cell
+        order = [d for d in by if d in keep]
+        if len(order) > 1 and order != list(keep):
+            cell = cell.reorder_levels(order).sort_index()
+        return cell.copy() # protect the cube against changes by the caller
+
+#end class rollup_cube
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+runner - runs a per-scenario table function over all results in a result_stack
+in worker processes, and merges the partial results on the driver (map-reduce)
+
+Example:
+    def gdp_table(m):                       # must be importable by the workers
+        return metropy.macro_table(m)
+
+    report = runner.map_reduce(stack, gdp_table, reduce=runner.concat_results,
+                               max_workers=8, retries=1)
+    report.reduced                          # tables side by side, in stack order
+    report.failed                           # {dataID: error} of scenarios that failed
+
+@author: VanTongeren_F
+"""
+# standard library imports
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# third party imports
+import pandas as pd
+
+# local imports
+from metro import metropy
+from metro import sharedmem
+
+def scenario_spec(metro_obj)-> dict:
+    ''' returns what a worker needs to open metro_obj itself: a dict of its
+    dataID, path, setpath and legend '''
+    return {'dataID': metro_obj.dataID, 'path': metro_obj.path,
+            'setpath': metro_obj.setpath, 'legend': metro_obj.legend}
+
+def open_scenario(spec):
+    ''' returns a new metro_data object from a scenario_spec() dict
+    The results file is only read when the object's data is first used
+    A sharedmem.shared_results spec gives a view on its shared memory instead '''
+    if 'segment' in spec:
+        return sharedmem.attach(spec)
+    metro_obj = metropy.metro_data(spec['dataID'])
+    metro_obj.path = spec['path']
+    metro_obj.setpath = spec['setpath']
+    metro_obj.legend = spec['legend']
+    return metro_obj
+
+def _run_chunk(func, specs)-> list:
+    ''' runs func on each scenario in specs (in a worker)
+    Returns a list of (ok, output or error message, seconds) per scenario '''
+    out = []
+    for spec in specs:
+        t0 = time.perf_counter()
+        try:
+            out.append((True, func(open_scenario(spec)), time.perf_counter() - t0))
+        except (Exception, SystemExit): # metro_data.data exits on unreadable files
+            out.append((False, traceback.format_exc(), time.perf_counter() - t0))
+    return out
+
+class run_report(object):
+    '''
+    Outcome of map_reduce()
+
+    results: OrderedDict {dataID: output of func}, in stack order
+    failed:  OrderedDict {dataID: error message}, scenarios that failed all attempts
+    attempts: {dataID: number of attempts}
+    seconds: {dataID: seconds spent in func in the last attempt}
+    reduced: output of the reduce function, None if no reduce function was given
+    wall_seconds: total run time on the driver
+    '''
+    def __init__(self):
+        self.results = OrderedDict()
+        self.failed = OrderedDict()
+        self.attempts = {}
+        self.seconds = {}
+        self.reduced = None
+        self.wall_seconds = 0.0
+
+    def summary(self)-> dict:
+        ''' returns a machine-readable summary of the run '''
+        return {'scenarios': len(self.results) + len(self.failed),
+                'succeeded': list(self.results.keys()),
+                'failed': list(self.failed.keys()),
+                'attempts': dict(self.attempts),
+                'seconds': {k: round(v, 3) for k, v in self.seconds.items()},
+                'wall_seconds': round(self.wall_seconds, 3)}
+
+#end class run_report
+
+def map_reduce(stack, func, reduce=None, executor=None, max_workers=None,
+               chunksize=1, retries=0, shared=None)-> run_report:
+    '''
+    Runs func(metro_obj) for every metro_data object in stack in worker processes
+    and merges the outputs with reduce
+
+    PARAMETERS
+    ----------
+    stack:   a metropy.result_stack
+    func:    function taking a metro_data object; it must be picklable (defined at
+             module level) when run in other processes
+    reduce:  optional function taking the OrderedDict {dataID: output} of the
+             succeeded scenarios, in stack order, e.g. concat_results
+    executor: a concurrent.futures style executor (anything with submit() returning
+             futures), default is a ProcessPoolExecutor(max_workers) for this run
+    chunksize: number of scenarios sent to a worker in one task
+    retries: number of times failed scenarios are submitted again
+    shared:  optional {dataID: sharedmem.shared_results} of scenarios published in
+             shared memory, which the workers attach instead of reading their files
+
+    Each worker opens its own scenarios from their path (see scenario_spec()), so the
+    data loaded in the driver is not sent to the workers.
+
+    RETURNS
+    -------
+    a run_report
+    '''
+    t0 = time.perf_counter()
+    shared = shared or {}
+    specs = [shared[k.dataID].spec if k.dataID in shared else scenario_spec(k)
+             for k in stack.get_results()]
+    ids = [s['dataID'] for s in specs]
+    outcome = {} # position in stack: (ok, output or message, seconds)
+    attempts = [0] * len(specs)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers)
+    try:
+        pending = list(range(len(specs)))
+        for _ in range(retries + 1):
+            if not pending:
+                break
+            chunks = [pending[i:i + chunksize] for i in range(0, len(pending), chunksize)]
+            futures = [executor.submit(_run_chunk, func, [specs[p] for p in c])
+                       for c in chunks]
+            pending = []
+            for chunk, future in zip(chunks, futures):
+                try:
+                    chunk_out = future.result()
+                except Exception: # the task itself failed, e.g. a worker died
+                    chunk_out = [(False, traceback.format_exc(), 0.0)] * len(chunk)
+                for p, out in zip(chunk, chunk_out):
+                    attempts[p] += 1
+                    outcome[p] = out
+                    if not out[0]:
+                        pending.append(p)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    report = run_report()
+    for p in range(len(specs)):
+        ok, value, seconds = outcome[p]
+        if ok:
+            report.results[ids[p]] = value
+        else:
+            report.failed[ids[p]] = value
+            print(f'* ERROR * scenario "{ids[p]}" failed after {attempts[p]} attempt(s):\n{value}')
+        report.attempts[ids[p]] = attempts[p]
+        report.seconds[ids[p]] = seconds
+
+    if reduce is not None:
+        report.reduced = reduce(report.results)
+    report.wall_seconds = time.perf_counter() - t0
+    return report
+#end map_reduce()
+
+def concat_results(results, axis=1):
+    ''' reduce function for map_reduce(): puts the output tables side by side (axis=1)
+    or below each other (axis=0), with the dataIDs as outer level '''
+    return pd.concat(results, axis=axis)
+#end concat_results()
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+server - a local read-only query server keeping the results of a result_stack loaded
+for many users, and a thin client returning the same dataframes as the local API
+
+The server loads the stack once and answers HTTP GET requests on localhost (TCP, or a
+Unix socket with path=). Frames are sent as Arrow IPC streams, Parquet or JSON.
+Identical requests arriving while one is being computed share its computation, and
+encoded responses are kept in an LRU cache with a byte budget.
+
+Endpoints (query parameters after ?):
+    /dataIDs                                    JSON list of the dataIDs in the stack
+    /dimensions?dataID=                         JSON dict, metro_data.dimensions
+    /variable?dataID=&v=&format=                metro_data.get_variable(v)
+    /macro_table?dataID=&longnames=0&format=    metropy.macro_table()
+    /stats                                      JSON dict of request and cache counts
+format is arrow (default), parquet or json; arrow and parquet need pyarrow.
+
+Example:
+    srv = server.query_server(stack, port=8765)
+    srv.run()                                   # blocks, or srv.start_background()
+
+    client = server.query_client(port=8765)     # in another process
+    client.get_variable('base', 'QER')          # same as base.get_variable('QER')
+    client.get_var('QER')                       # same as stack.get_var('QER')
+
+@author: VanTongeren_F
+"""
+# standard library imports
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from metro import arrowtools
+from metro import metropy
+
+CONTENT_TYPES = {'json': 'application/json',
+                 'arrow': 'application/vnd.apache.arrow.stream',
+                 'parquet': 'application/vnd.apache.parquet'}
+
+#%% encoding
+def _labels(index):
+    ''' returns the labels and names of an index as JSON-compatible lists '''
+    return ([list(l) if isinstance(l, tuple) else l for l in index.tolist()],
+            list(index.names))
+
+def _index(labels, names):
+    if len(names) > 1:
+        return pd.MultiIndex.from_tuples([tuple(l) for l in labels], names=names)
+    return pd.Index(labels, name=names[0])
+
+def encode_frame(df, fmt='arrow')-> bytes:
+    ''' returns dataframe or series df encoded in format fmt (arrow, parquet or json) '''
+    if fmt == 'json':
+        series = isinstance(df, pd.Series)
+        frame = df.to_frame() if series else df
+        index, index_names = _labels(frame.index)
+        columns, column_names = _labels(frame.columns)
+        values = frame.to_numpy(dtype=np.float64)
+        return json.dumps({'series': series, 'name': df.name if series else None,
+                           'index': index, 'index_names': index_names,
+                           'columns': columns, 'column_names': column_names,
+                           'data': np.where(np.isnan(values), None, values).tolist()
+                           }).encode()
+
+    table = arrowtools.frame_to_arrow(df)
+    sink = arrowtools.pa.BufferOutputStream()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, sink)
+    else:
+        with arrowtools.pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def decode_frame(body, fmt='arrow'):
+    ''' returns the dataframe or series encoded by encode_frame() '''
+    if fmt == 'json':
+        d = json.loads(body)
+        df = pd.DataFrame(np.array(d['data'], dtype=np.float64).reshape(
+                              len(d['index']), len(d['columns'])),
+                          index=_index(d['index'], d['index_names']),
+                          columns=_index(d['columns'], d['column_names']))
+        return df.iloc[:, 0].rename(d['name']) if d['series'] else df
+
+    buf = arrowtools.pa.py_buffer(body)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(arrowtools.pa.BufferReader(buf))
+    else:
+        table = arrowtools.pa.ipc.open_stream(buf).read_all()
+    return arrowtools.arrow_to_frame(table)
+
+#%% server
+class _request_error(Exception):
+    ''' error answered with HTTP status code status '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class query_server(object):
+    '''
+    Serves the results of result_stack stack on localhost
+
+    host, port: TCP address, port=0 picks a free port (see the port attribute)
+    path:       path of a Unix socket to listen on instead of TCP
+    cache_max_bytes: byte budget of the LRU cache of encoded responses
+    executor:   executor computing the responses, default is a single thread, as
+                metro_data objects are not thread-safe
+    '''
+    def __init__(self, stack, host='127.0.0.1', port=8765, path=None,
+                 cache_max_bytes=256 * 2**20, executor=None):
+        self.stack = stack
+        self.host = host
+        self.port = port
+        self.path = path
+        self.cache_max_bytes = cache_max_bytes
+        self._executor = executor or ThreadPoolExecutor(1, thread_name_prefix='metro_server')
+        self._by_id = {k.dataID: k for k in stack.get_results()}
+        self._cache = OrderedDict() # request key: (content type, body)
+        self._cache_bytes = 0
+        self._inflight = {} # request key: asyncio future computing the response
+        self._stats = {'requests': 0, 'hits': 0, 'coalesced': 0, 'computed': 0,
+                       'errors': 0, 'evictions': 0}
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    async def start(self, max_concurrent=4):
+        ''' loads all results in the stack and starts listening '''
+        await self.stack.aload(max_concurrent)
+        if self.path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        print(f'metro query server ready on {self.path or f"{self.host}:{self.port}"}')
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def run(self, max_concurrent=4):
+        ''' starts the server and serves until interrupted (Ctrl-C) '''
+        async def serve():
+            await self.start(max_concurrent)
+            async with self._server:
+                await self._server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+
+    def start_background(self, max_concurrent=4):
+        ''' starts the server in a background thread, returns when it is ready '''
+        started = {}
+        ready = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.start(max_concurrent))
+            except BaseException as e: # reported to the caller
+                started['error'] = e
+                ready.set()
+                return
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        ready.wait()
+        if 'error' in started:
+            raise started['error']
+        return self
+
+    def stop_background(self):
+        ''' stops a server started with start_background() '''
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def stats(self)-> dict:
+        ''' returns the counts of requests, cache hits, coalesced and computed responses,
+        errors and cache evictions, and the entries and bytes in the cache '''
+        return {**self._stats, 'entries': len(self._cache), 'bytes': self._cache_bytes,
+                'max_bytes': self.cache_max_bytes}
+
+    def _metro_obj(self, params):
+        dataID = params.get('dataID')
+        if dataID not in self._by_id:
+            raise _request_error(404, f'* ERROR * There is no dataID "{dataID}" in the stack')
+        return self._by_id[dataID]
+
+    def _compute(self, endpoint, params):
+        ''' returns (content type, body) of a request (in the executor) '''
+        fmt = params.get('format', 'arrow')
+        if fmt not in CONTENT_TYPES:
+            raise _request_error(400, f'* ERROR * Unknown format "{fmt}"')
+
+        if endpoint == '/dataIDs':
+            return CONTENT_TYPES['json'], json.dumps(list(self._by_id)).encode()
+        if endpoint == '/dimensions':
+            dims = self._metro_obj(params).dimensions
+            return CONTENT_TYPES['json'], json.dumps(dims).encode()
+        if endpoint == '/variable':
+            if 'v' not in params:
+                raise _request_error(400, '* ERROR * Missing parameter v')
+            df = self._metro_obj(params).get_variable(params['v'])
+            if df is None:
+                raise _request_error(404, f'* ERROR * There is no variable "{params["v"]}" '
+                                          f'in the results file')
+        elif endpoint == '/macro_table':
+            df = metropy.macro_table(self._metro_obj(params),
+                                     longnames=params.get('longnames', '0') == '1')
+        else:
+            raise _request_error(404, f'* ERROR * Unknown request {endpoint}')
+        return CONTENT_TYPES[fmt], encode_frame(df, fmt)
+
+    async def _respond(self, endpoint, params):
+        ''' returns (content type, body), from the cache, from a computation of the same
+        request in flight, or computed now '''
+        key = (endpoint, tuple(sorted(params.items())))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self._stats['hits'] += 1
+            return self._cache[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats['coalesced'] += 1
+        else:
+            loop = asyncio.get_running_loop()
+            task = loop.run_in_executor(self._executor, self._compute, endpoint, params)
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+            task.add_done_callback(lambda t: self._store(key, t))
+            self._stats['computed'] += 1
+        return await asyncio.shield(task)
+
+    def _store(self, key, task):
+        ''' keeps the response of a finished task in the cache, within its budget '''
+        if task.cancelled() or task.exception() is not None:
+            return
+        nbytes = len(task.result()[1])
+        if nbytes > self.cache_max_bytes:
+            return
+        self._cache[key] = task.result()
+        self._cache_bytes += nbytes
+        while self._cache_bytes > self.cache_max_bytes:
+            _, (_, body) = self._cache.popitem(last=False)
+            self._cache_bytes -= len(body)
+            self._stats['evictions'] += 1
+
+    async def _handle(self, reader, writer):
+        ''' answers one HTTP request on a connection '''
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''): # skip headers
+                pass
+            self._stats['requests'] += 1
+            try:
+                if len(request) < 2 or request[0] != 'GET':
+                    raise _request_error(405, '* ERROR * Only GET requests are served')
+                url = urllib.parse.urlsplit(request[1])
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if url.path == '/stats':
+                    status, ctype, body = 200, CONTENT_TYPES['json'], \
+                        json.dumps(self.stats()).encode()
+                else:
+                    status = 200
+                    ctype, body = await self._respond(url.path, params)
+            except _request_error as e:
+                self._stats['errors'] += 1
+                status, ctype, body = e.status, CONTENT_TYPES['json'], \
+                    json.dumps({'error': str(e)}).encode()
+            except Exception as e: # keep serving other requests
+                self._stats['errors'] += 1
+                status, ctype, body = 500, CONTENT_TYPES['json'], \
+                    json.dumps({'error': f'{type(e).__name__}: {e}'}).encode()
+
+            reason = http.client.responses.get(status, '')
+            writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {ctype}\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+                         .encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError: # client went away
+            pass
+        finally:
+            writer.close()
+
+#end class query_server
+
+#%% client
+class _unix_connection(http.client.HTTPConnection):
+    ''' HTTP connection over the Unix socket path '''
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+class query_client(object):
+    '''
+    Client of a query_server, with the same results as the local API
+
+    host, port or path: address of the server, see query_server
+    format: arrow (default), parquet or json
+    '''
+    def __init__(self, host='127.0.0.1', port=8765, path=None, format='arrow', timeout=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.format = format
+        self.timeout = timeout
+
+    def _get(self, endpoint, **params):
+        ''' returns (status, body) of GET endpoint?params '''
+        if self.path is not None:
+            conn = _unix_connection(self.path, self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', endpoint + '?' + urllib.parse.urlencode(params))
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def _json(self, endpoint, **params):
+        status, body = self._get(endpoint, **params)
+        if status != 200:
+            raise KeyError(json.loads(body)['error'])
+        return json.loads(body)
+
+    def _frame(self, endpoint, **params):
+        ''' returns the frame answered to endpoint, None (after printing the error)
+        if it does not exist '''
+        status, body = self._get(endpoint, format=self.format, **params)
+        if status == 404:
+            print(json.loads(body)['error'])
+            return None
+        if status != 200:
+            raise RuntimeError(json.loads(body)['error'])
+        return decode_frame(body, self.format)
+
+    def get_dataIDs(self)-> list:
+        return self._json('/dataIDs')
+
+    def dimensions(self, dataID)-> dict:
+        return self._json('/dimensions', dataID=dataID)
+
+    def get_variable(self, dataID, v):
+        ''' returns metro_data.get_variable(v) of scenario dataID '''
+        return self._frame('/variable', dataID=dataID, v=v)
+
+    def get_var(self, v)-> dict:
+        ''' returns result_stack.get_var(v): {dataID: get_variable(v)} '''
+        return {k: self.get_variable(k, v) for k in self.get_dataIDs()}
+
+    def macro_table(self, dataID, longnames=False):
+        ''' returns metropy.macro_table() of scenario dataID '''
+        return self._frame('/macro_table', dataID=dataID, longnames=int(longnames))
+
+    def stats(self)-> dict:
+        return self._json('/stats')
+
+    def wait(self, seconds=30.0):
+        ''' waits until the server answers, at most seconds '''
+        t_end = time.monotonic() + seconds
+        while True:
+            try:
+                return self.stats()
+            except OSError:
+                if time.monotonic() > t_end:
+                    raise
+                time.sleep(0.1)
+
+#end class query_client
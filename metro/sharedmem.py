@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+sharedmem - publishes a loaded METRO results table in shared memory, so worker
+processes can use it without parsing the file again or receiving it by pickle
+
+The results are stored once in a multiprocessing.shared_memory segment: integer
+codes of the key columns and the values, with the rows grouped by variable. Workers
+attach a read-only metro_data view on the segment; get_variable(), dimensions and
+sets work as usual, and the rows of a variable are read from their block of the
+segment without copying the rest.
+
+Example:
+    with sharedmem.shared_results(base) as shared:        # in the driver
+        pool.map(work, [shared.spec] * n)                  # spec is a small dict
+
+    def work(spec):                                        # in a worker
+        m = sharedmem.attach(spec)
+        df = m.get_variable('QER')
+        sharedmem.detach(m)
+
+The segment is removed when the shared_results is closed (or garbage collected),
+so it must stay open while workers use it.
+
+@author: VanTongeren_F
+"""
+# standard library imports
+import os
+import weakref
+from multiprocessing import shared_memory
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from metro import metropy
+from metro.keyspace import KEY_COLS
+from metro.stores import results_store
+
+def _open_segment(name):
+    ''' attaches the existing shared memory segment name, without making this process
+    responsible for removing it. Before python 3.13 this relies on the process sharing
+    the resource tracker of the publishing process, as multiprocessing workers do '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # python >= 3.13
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _views(buf, layout, writeable=False):
+    ''' returns {array name: numpy view on buf} for layout
+    {array name: (offset, length, dtype)} '''
+    arrays = {}
+    for name, (offset, length, dtype) in layout.items():
+        a = np.ndarray((length,), dtype=dtype, buffer=buf, offset=offset)
+        a.flags.writeable = writeable
+        arrays[name] = a
+    return arrays
+
+def _unlink(shm, pid=None):
+    ''' closes segment shm, and removes it if this is process pid that created it '''
+    try:
+        shm.close()
+    except BufferError: # views still exported, the mapping goes with the process
+        pass
+    if os.getpid() == pid:
+        try:
+            shm.unlink()
+        except FileNotFoundError: # already removed
+            pass
+
+class shared_results(object):
+    '''
+    The results table of metro_data object metro_obj, published in a shared memory
+    segment. Loads the data of metro_obj if necessary.
+
+    spec: a picklable dict describing the segment, to pass to attach() in the workers
+    close(): removes the segment; also done when leaving a with block or when the
+             object is garbage collected
+    '''
+    def __init__(self, metro_obj):
+        res = metro_obj.data['results']
+        codes, categories = {}, {}
+        for c in KEY_COLS:
+            codes[c], uniques = pd.factorize(res[c])
+            categories[c] = [str(u) for u in uniques]
+        order = np.argsort(codes['variable'], kind='stable') # rows grouped by variable
+        bounds = np.searchsorted(codes['variable'][order],
+                                 np.arange(len(categories['variable']) + 1))
+        values = res['value'].to_numpy()
+
+        layout, offset = {}, 0
+        for name, dtype in [(c, np.dtype(np.int32)) for c in KEY_COLS] + \
+                           [('value', values.dtype)]:
+            offset = -(-offset // dtype.itemsize) * dtype.itemsize # align
+            layout[name] = (offset, len(res), dtype.str)
+            offset += len(res) * dtype.itemsize
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        self._finalizer = weakref.finalize(self, _unlink, self._shm, os.getpid())
+        arrays = _views(self._shm.buf, layout, writeable=True)
+        for c in KEY_COLS:
+            arrays[c][:] = codes[c][order]
+        arrays['value'][:] = values[order]
+        del arrays # no views may remain for the segment to be closed
+
+        self.spec = {'segment': self._shm.name, 'layout': layout,
+                     'categories': categories, 'bounds': bounds.tolist(),
+                     'dataID': metro_obj.dataID, 'path': metro_obj.path,
+                     'setpath': metro_obj.setpath, 'legend': metro_obj.legend,
+                     'sets': metro_obj.sets}
+
+    @property
+    def nbytes(self):
+        return self._shm.size
+
+    def close(self):
+        ''' removes the shared memory segment; attached views can no longer be made '''
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#end class shared_results
+
+class shared_store(results_store):
+    '''
+    A read-only results store on a segment published by shared_results, made from
+    its spec. Can be attached to a metro_data object with metro_data.attach_store()
+    '''
+    def __init__(self, spec):
+        self._shm = _open_segment(spec['segment'])
+        self._finalizer = weakref.finalize(self, _unlink, self._shm)
+        self.arrays = _views(self._shm.buf, spec['layout'])
+        self.categories = {c: np.array(spec['categories'][c], dtype=object)
+                           for c in KEY_COLS}
+        self.bounds = spec['bounds']
+
+    def _rows(self, start, stop):
+        df = pd.DataFrame({c: self.categories[c][self.arrays[c][start:stop]]
+                           for c in KEY_COLS})
+        df['value'] = self.arrays['value'][start:stop] # copied into the frame
+        return df
+
+    def results(self):
+        return self._rows(0, len(self.arrays['value']))
+
+    def variable_rows(self, v):
+        found = np.flatnonzero(self.categories['variable'] == v)
+        if not len(found):
+            return self._rows(0, 0)
+        return self._rows(self.bounds[found[0]], self.bounds[found[0] + 1])
+
+    def uniques(self, col):
+        return list(self.categories[col]) # in order of first appearance
+
+    @property
+    def nbytes(self):
+        return 0 # the segment is shared, not held by this process
+
+    def close(self):
+        ''' unmaps the segment in this process '''
+        self.arrays = {}
+        self._finalizer()
+
+#end class shared_store
+
+def attach(spec):
+    ''' returns a read-only metro_data view on the results published by
+    shared_results, given its spec '''
+    metro_obj = metropy.metro_data(spec['dataID'])
+    metro_obj.path = spec['path']
+    metro_obj.setpath = spec['setpath']
+    metro_obj.legend = spec['legend']
+    metro_obj._sets = spec['sets']
+    store = shared_store(spec)
+    metro_obj.set_precision(store.arrays['value'].dtype)
+    metro_obj.attach_store(store)
+    return metro_obj
+
+def detach(metro_obj):
+    ''' detaches metro_obj, made by attach(), from the shared memory segment '''
+    store = metro_obj._store
+    metro_obj.attach_store(None)
+    if isinstance(store, shared_store):
+        store.close()
@@ -4,7 +4,11 @@ A small statistical toolbox
 
 @author: VanTongeren_F
 """
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import pandas as pd
 from scipy import stats
 
 def get_stats(g)-> dict:
@@ -46,6 +50,70 @@ def get_wavg(g, data, weights)->float:
     return np.average(g[data], weights=g[weights])
 # end get_wavg()
 
+def grouped_wavg(df, by, data, weights, zero_weights='nan')-> pd.DataFrame:
+    '''
+    Calculates weighted averages of many columns per group in one vectorized pass.
+    For each data column the result equals
+        df.groupby(by).apply(lambda g: get_wavg(g, data, weights))
+    but without a Python call per group: rows are sorted by group once and the
+    weighted sums of all groups and columns are taken at once for all groups of
+    the same size.
+    ...
+    Parameters
+    ----------
+    df:     pandas data frame
+
+    by:     label(s) of column(s) or index level(s) to group by, as in df.groupby(by)
+    data:   str or list
+        label(s) of the column(s) in df over which to calculate weighted averages,
+        e.g. the scenario columns of a pct_diff_list() output
+    weights: str or list
+        label of the column to use as weights for all data columns, or a list with
+        one weight column label per data column
+    zero_weights: str
+        'nan' gives NaN for groups whose weights sum to zero, 'raise' raises a
+        ZeroDivisionError like get_wavg
+
+    RETURNS
+    -------
+    data frame with the weighted averages, one row per group and one column per
+    data column
+    '''
+    data = data if isinstance(data, list) else [data]
+    weights = weights if isinstance(weights, list) else [weights] * len(data)
+    if len(weights) != len(data):
+        raise ValueError('* ERROR * give one weight column, or one per data column')
+
+    grouped = df.groupby(by)
+    codes = grouped.ngroup().to_numpy()
+    keep = codes >= 0 # rows with missing group keys are not in any group
+    order = np.argsort(codes[keep], kind='stable')
+    starts = np.searchsorted(codes[keep][order], np.arange(grouped.ngroups))
+
+    x = df[data].to_numpy(dtype=np.float64)[keep][order]
+    w = df[weights].to_numpy(dtype=np.float64)[keep][order]
+    wx = x * w
+
+    # groups of equal size are summed together as rows of a (columns, groups, size)
+    # array, so every group is summed in the same order as np.average would
+    sizes = np.diff(np.r_[starts, len(x)])
+    sum_wx = np.empty((grouped.ngroups, len(data)))
+    sum_w = np.empty((grouped.ngroups, len(data)))
+    for m in np.unique(sizes):
+        g = np.flatnonzero(sizes == m)
+        rows = starts[g][:, None] + np.arange(m)
+        sum_wx[g] = np.ascontiguousarray(np.moveaxis(wx[rows], 1, -1)).sum(axis=-1)
+        sum_w[g] = np.ascontiguousarray(np.moveaxis(w[rows], 1, -1)).sum(axis=-1)
+
+    zero = sum_w == 0
+    if zero.any():
+        if zero_weights == 'raise':
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+        sum_w[zero] = np.nan
+
+    return pd.DataFrame(sum_wx / sum_w, index=grouped.size().index, columns=data)
+# end grouped_wavg()
+
 def comp_tstat(group, variable)->list:
     '''
     Computes t-statistics for testing signifcance of difference of group means
@@ -79,6 +147,130 @@ def comp_tstat(group, variable)->list:
     return tstat
 #end comp_tstat()
 
+def _resample_chunks(n_resamples, chunk_size, seed_seq):
+    '''
+    Splits n_resamples into chunks of at most chunk_size resamples, each with its own
+    random generator spawned from the numpy SeedSequence seed_seq, so the resamples
+    are the same whatever the number of threads used.
+    Returns a list of (number of resamples, generator)
+    '''
+    sizes = [chunk_size] * (n_resamples // chunk_size)
+    if n_resamples % chunk_size:
+        sizes.append(n_resamples % chunk_size)
+    return [(n, np.random.default_rng(s)) for n, s in zip(sizes, seed_seq.spawn(len(sizes)))]
+
+def _map_chunks(func, chunks, n_jobs):
+    ''' returns [func(n, rng) for (n, rng) in chunks], using n_jobs threads
+    (n_jobs=-1: all cores); numpy releases the GIL in the heavy array operations '''
+    if n_jobs == 1 or len(chunks) == 1:
+        return [func(n, rng) for n, rng in chunks]
+    workers = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(lambda c: func(*c), chunks))
+
+def bootstrap_ci(group, variables, n_resamples=10000, ci=0.95, statistic=np.mean,
+                 seed=None, chunk_size=1000, n_jobs=1)-> pd.DataFrame:
+    '''
+    Computes bootstrap percentile confidence intervals of a statistic of variables
+    for every group in a groupby object
+    All resamples of a chunk are drawn as one index matrix (resamples x group size)
+    and applied to all groups of the same size and all variables at once.
+    ...
+    PARAMETERS
+    group:      pandas groupby object
+    variables: str or list
+        label(s) of the variable(s) to select from group
+    n_resamples: number of bootstrap resamples
+    ci:         confidence level, e.g. 0.95
+    statistic:  numpy reduction accepting an axis argument, e.g. np.mean, np.median
+    seed:       seed for reproducible resamples
+    chunk_size: resamples drawn at once. Memory use is about
+                8 bytes * chunk_size * group size * variables * groups of that size
+    n_jobs:     number of threads working on chunks, -1 for all cores
+
+    RETURNS
+    -------
+    dataframe with a row per group and columns (variable, 'estimate'/'lower'/'upper')
+    '''
+    variables = variables if isinstance(variables, list) else [variables]
+    data = [g[variables].to_numpy(dtype=np.float64) for _, g in group]
+    sizes = np.array([len(x) for x in data])
+    estimate = np.array([statistic(x, axis=0) for x in data])
+    lower = np.empty_like(estimate)
+    upper = np.empty_like(estimate)
+    alpha = (1 - ci) / 2
+
+    buckets = np.unique(sizes)
+    for m, seed_seq in zip(buckets, np.random.SeedSequence(seed).spawn(len(buckets))):
+        g = np.flatnonzero(sizes == m)
+        x = np.stack([data[i] for i in g]) # groups x m x variables
+
+        def resample(n, rng):
+            idx = rng.integers(0, m, size=(n, m))
+            return statistic(x[:, idx], axis=2) # groups x n x variables
+
+        boot = np.concatenate(_map_chunks(resample, _resample_chunks(n_resamples, chunk_size,
+                                                                     seed_seq), n_jobs), axis=1)
+        lower[g] = np.quantile(boot, alpha, axis=1)
+        upper[g] = np.quantile(boot, 1 - alpha, axis=1)
+
+    columns = pd.MultiIndex.from_product([variables, ['estimate', 'lower', 'upper']])
+    res = np.stack([estimate, lower, upper], axis=2).reshape(len(data), -1)
+    return pd.DataFrame(res, index=group.size().index, columns=columns)
+#end bootstrap_ci()
+
+def permutation_test(group, variables, n_resamples=10000, seed=None, chunk_size=1000,
+                     n_jobs=1)-> pd.DataFrame:
+    '''
+    Tests the significance of differences of group means with two-sided permutation
+    tests, for every pair of groups (as comp_tstat), without assuming normality
+    All permutations of a chunk are drawn as one index matrix (permutations x pooled
+    size) and applied to all variables at once.
+    ...
+    PARAMETERS
+    group:      pandas groupby object
+    variables: str or list
+        label(s) of the variable(s) to select from group
+    n_resamples: number of random permutations
+    seed:       seed for reproducible permutations
+    chunk_size: permutations drawn at once. Memory use is about
+                8 bytes * chunk_size * pooled size of a pair * variables
+    n_jobs:     number of threads working on chunks, -1 for all cores
+
+    RETURNS
+    -------
+    dataframe with a row per pair of groups (group1, group2) and columns
+    (variable, 'diff'/'p-value'), diff = mean(group1) - mean(group2)
+    '''
+    variables = variables if isinstance(variables, list) else [variables]
+    keys = list(group.groups.keys())
+    data = [group.get_group(k)[variables].to_numpy(dtype=np.float64) for k in keys]
+    pairs = [(i, j) for i in range(len(keys)) for j in range(i + 1, len(keys))]
+
+    res = np.empty((len(pairs), len(variables), 2))
+    seeds = np.random.SeedSequence(seed).spawn(len(pairs))
+    for p, ((i, j), seed_seq) in enumerate(zip(pairs, seeds)):
+        pooled = np.concatenate([data[i], data[j]])
+        n_i, n = len(data[i]), len(pooled)
+        observed = data[i].mean(axis=0) - data[j].mean(axis=0)
+        threshold = np.abs(observed) * (1 - 1e-12) # ignore rounding in equal differences
+
+        def count(n_perm, rng):
+            perm = np.argsort(rng.random((n_perm, n)), axis=1)
+            x = pooled[perm] # permutations x n x variables
+            diff = x[:, :n_i].mean(axis=1) - x[:, n_i:].mean(axis=1)
+            return (np.abs(diff) >= threshold).sum(axis=0)
+
+        counts = sum(_map_chunks(count, _resample_chunks(n_resamples, chunk_size, seed_seq),
+                                 n_jobs))
+        res[p] = np.column_stack([observed, (counts + 1) / (n_resamples + 1)])
+
+    index = pd.MultiIndex.from_tuples([(keys[i], keys[j]) for i, j in pairs],
+                                      names=['group1', 'group2'])
+    columns = pd.MultiIndex.from_product([variables, ['diff', 'p-value']])
+    return pd.DataFrame(res.reshape(len(pairs), -1), index=index, columns=columns)
+#end permutation_test()
+
 def main():
     pass
 if __name__ == "__main__":
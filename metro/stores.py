@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+stores - alternative storage for the results table of a metro_data object
+
+A store replaces metro_data._data['results']. metro_data asks its store for the
+rows of one variable (get_variable) or for the complete table (data, dimensions).
+
+@author: VanTongeren_F
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+#%% columnar copies of loaded data
+def write_columnar(frames, path):
+    ''' Writes a dict of dataframes (e.g. metro_data.data) to a numpy .npz file at path
+    String columns are stored as int32 codes plus their categories, so reading the
+    file back is much faster than parsing the GDX file again.
+    '''
+    arrays = {}
+    meta = []
+    for i, (name, df) in enumerate(frames.items()):
+        meta.append([name, list(df.columns)])
+        for j, c in enumerate(df.columns):
+            col = df[c]
+            if pd.api.types.is_numeric_dtype(col) or pd.api.types.is_bool_dtype(col):
+                arrays[f'{i}_{j}_values'] = col.to_numpy()
+            else:
+                codes, uniques = pd.factorize(col)
+                arrays[f'{i}_{j}_codes'] = codes.astype(np.int32)
+                arrays[f'{i}_{j}_cats'] = np.asarray(uniques, dtype=str)
+    arrays['meta'] = np.array(json.dumps(meta))
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+def read_columnar(path):
+    ''' Reads a dict of dataframes written by write_columnar() '''
+    with np.load(path) as npz:
+        frames = {}
+        for i, (name, columns) in enumerate(json.loads(str(npz['meta']))):
+            cols = {}
+            for j, c in enumerate(columns):
+                if f'{i}_{j}_values' in npz:
+                    cols[c] = npz[f'{i}_{j}_values']
+                else:
+                    # code -1 (missing value) picks the None appended at the end
+                    cats = np.append(npz[f'{i}_{j}_cats'].astype(object), None)
+                    cols[c] = cats[npz[f'{i}_{j}_codes']]
+            frames[name] = pd.DataFrame(cols, columns=columns)
+    return frames
+
+#%% stores
+class results_store(object):
+    '''
+    Base class for stores of a METRO results table.
+    Subclasses implement results(); variable_rows() and uniques() fall back on it
+    '''
+    def results(self):
+        ''' returns the complete results dataframe '''
+        raise NotImplementedError
+
+    def variable_rows(self, v):
+        ''' returns the rows of the results dataframe for variable v '''
+        res = self.results()
+        return res[res['variable'] == v]
+
+    def uniques(self, col):
+        ''' returns the unique values in column col of the results, in order of appearance '''
+        return list(self.results()[col].unique())
+
+    @property
+    def nbytes(self):
+        ''' approximate memory held by the store in bytes '''
+        return 0
+
+#end class results_store
+
+class keyed_store(results_store):
+    '''
+    Stores a results table as values on a keyspace.key_space, shared with other
+    scenarios. Used for the reference scenario of a compressed result_stack.
+    The values keep the dtype of the value column of frame.
+    '''
+    def __init__(self, keys, frame):
+        self.keys = keys
+        self.values, self.present = keys.align(frame, frame['value'].dtype)
+
+    def _rows(self, start, stop):
+        rows = np.arange(start, stop)[self.present[start:stop]]
+        return self.keys.frame(rows, self.values[rows])
+
+    def results(self):
+        return self._rows(0, len(self.keys))
+
+    def aligned(self):
+        ''' returns the values on the key space, NaN where absent '''
+        return np.where(self.present, self.values, np.nan)
+
+    def variable_rows(self, v):
+        return self._rows(*self.keys.var_range(v))
+
+    def uniques(self, col):
+        return self.keys.uniques(col, np.flatnonzero(self.present))
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.present.nbytes
+
+#end class keyed_store
+
+class delta_store(results_store):
+    '''
+    Stores a results table as a sparse delta over a reference keyed_store:
+    only the row ids whose value differs from the reference (or which are missing in
+    the reference) are kept with their values, plus the row ids of reference
+    rows that are absent from this table.
+    Values are stored, not differences, so rebuilt values are exact.
+    '''
+    def __init__(self, reference, frame):
+        self.reference = reference
+        values, present = reference.keys.align(frame, reference.values.dtype)
+        ref_values, ref_present = reference.values, reference.present
+        same = ref_present & ((values == ref_values)
+                              | (np.isnan(values) & np.isnan(ref_values)))
+        self.pos = np.flatnonzero(present & ~same)
+        self.delta = values[self.pos]
+        self.absent = np.flatnonzero(ref_present & ~present)
+
+    def _rows(self, start, stop):
+        values = self.reference.values[start:stop].copy()
+        present = self.reference.present[start:stop].copy()
+
+        i, j = np.searchsorted(self.pos, [start, stop])
+        values[self.pos[i:j] - start] = self.delta[i:j]
+        present[self.pos[i:j] - start] = True
+        i, j = np.searchsorted(self.absent, [start, stop])
+        present[self.absent[i:j] - start] = False
+
+        rows = np.arange(start, stop)[present]
+        return self.reference.keys.frame(rows, values[present])
+
+    def results(self):
+        return self._rows(0, len(self.reference.keys))
+
+    def aligned(self):
+        ''' returns the values on the key space, NaN where absent '''
+        values = self.reference.aligned()
+        values[self.pos] = self.delta
+        values[self.absent] = np.nan
+        return values
+
+    def variable_rows(self, v):
+        return self._rows(*self.reference.keys.var_range(v))
+
+    def uniques(self, col):
+        present = self.reference.present.copy()
+        present[self.pos] = True
+        present[self.absent] = False
+        return self.reference.keys.uniques(col, np.flatnonzero(present))
+
+    @property
+    def nbytes(self):
+        return self.pos.nbytes + self.delta.nbytes + self.absent.nbytes
+
+#end class delta_store
+
+#%% memory-mapped per-variable store
+MAPPED_MAGIC = b'METROMM1'
+MAPPED_DIMS = ['dim1', 'dim2', 'dim4', 'dim5'] # key columns in a variable's block
+
+def _align(n, size=64):
+    return -(-n // size) * size
+
+def write_mapped(results, path):
+    '''
+    Writes a results dataframe to file path in the layout read by mapped_store:
+    8 bytes magic, the header length (uint64), a JSON header with the labels of the
+    codes and the catalog {variable: [offset, rows]}, then one contiguous block per
+    variable with the int32 codes of dim1, dim2, dim4 and dim5 and the values
+    (in the dtype of the value column), each block aligned to 64 bytes.
+    '''
+    codes, labels = {}, {}
+    for c in ['variable'] + MAPPED_DIMS:
+        codes[c], uniques = pd.factorize(results[c])
+        labels[c] = [str(u) for u in uniques]
+    values = results['value'].to_numpy()
+    order = np.argsort(codes['variable'], kind='stable')
+    bounds = np.searchsorted(codes['variable'][order], np.arange(len(labels['variable']) + 1))
+
+    catalog, offset = {}, 0
+    for i, v in enumerate(labels['variable']):
+        n = int(bounds[i + 1] - bounds[i])
+        catalog[v] = [offset, n]
+        offset = _align(offset + n * 4 * len(MAPPED_DIMS))
+        offset = _align(offset + n * values.dtype.itemsize)
+
+    header = json.dumps({'dtype': values.dtype.str, 'labels': labels,
+                         'catalog': catalog}).encode()
+    data_start = _align(16 + len(header))
+    with open(path, 'wb') as f:
+        f.write(MAPPED_MAGIC + np.uint64(len(header)).tobytes() + header)
+        for i, v in enumerate(labels['variable']):
+            rows = order[bounds[i]:bounds[i + 1]]
+            f.seek(data_start + catalog[v][0])
+            for c in MAPPED_DIMS:
+                f.write(codes[c][rows].astype(np.int32).tobytes())
+            f.seek(_align(f.tell()))
+            f.write(values[rows].tobytes())
+        f.truncate(data_start + offset)
+#end write_mapped()
+
+class mapped_store(results_store):
+    '''
+    A results store on a file written by write_mapped(), opened with numpy.memmap
+    Opening only reads the header; get_variable(v) reads only the pages of the block
+    of v. Can be attached to a metro_data object with metro_data.attach_store()
+
+    Example:
+        stores.write_mapped(m.data['results'], 'base.mmap')     # once
+        m.attach_store(stores.mapped_store('base.mmap'))        # milliseconds
+        m.path = 'base.mmap'                                    # the same, attached on assignment
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(8) != MAPPED_MAGIC:
+                raise ValueError(f'* ERROR * {path} is not a file written by write_mapped()')
+            n = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(n))
+        self.dtype = np.dtype(header['dtype'])
+        self.labels = {c: np.array(l, dtype=object) for c, l in header['labels'].items()}
+        self.catalog = header['catalog']
+        self._data_start = _align(16 + n)
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def block(self, v):
+        ''' returns ({dim: int32 codes}, values) of variable v as read-only views on the
+        mapped file, None if v is not in the file '''
+        if v not in self.catalog:
+            return None
+        offset, n = self.catalog[v]
+        start = self._data_start + offset
+        codes = {}
+        for c in MAPPED_DIMS:
+            codes[c] = self._map[start:start + n * 4].view(np.int32)
+            start += n * 4
+        start = _align(start - self._data_start) + self._data_start
+        return codes, self._map[start:start + n * self.dtype.itemsize].view(self.dtype)
+
+    def _frame(self, v):
+        codes, values = self.block(v)
+        df = pd.DataFrame({c: self.labels[c][codes[c]] if c in codes else v
+                           for c in ['dim1', 'dim2', 'variable', 'dim4', 'dim5']})
+        df['value'] = np.array(values) # copy, the frame must not depend on the map
+        return df
+
+    def results(self):
+        ''' returns the complete results dataframe. NOTE: reads the whole file '''
+        frames = [self._frame(v) for v in self.catalog]
+        if not frames:
+            return pd.DataFrame(columns=['dim1', 'dim2', 'variable', 'dim4', 'dim5', 'value'])
+        return pd.concat(frames, ignore_index=True)
+
+    def variable_rows(self, v):
+        if v not in self.catalog:
+            return pd.DataFrame(columns=['dim1', 'dim2', 'variable', 'dim4', 'dim5', 'value'])
+        return self._frame(v)
+
+    def uniques(self, col):
+        return list(self.labels[col]) # in order of first appearance
+
+    @property
+    def nbytes(self):
+        return 0 # pages of the mapped file are held by the operating system
+
+#end class mapped_store
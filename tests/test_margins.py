@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Checks add_margins() (and add_ctotal(), add_rtotal()) against margins built with
+plain pandas groupby and concat
+
+run with: python -m pytest tests
+"""
+# third party imports
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('gdxpds')
+
+# local imports
+from metro import metropy
+
+NAME = 'TOTAL'
+
+def _total_row(df, label):
+    ''' returns a one-row dataframe labelled label with the sums of the numeric columns
+    of df (NaN counts as 0) and '' in the others '''
+    row = {c: df[c].sum() if pd.api.types.is_numeric_dtype(df[c]) else ''
+           for c in df.columns}
+    index = pd.MultiIndex.from_tuples([label], names=df.index.names) \
+        if isinstance(label, tuple) else pd.Index([label], name=df.index.name)
+    out = pd.DataFrame([row], index=index)
+    out.columns = df.columns
+    return out.astype({c: df[c].dtype for c in df.columns
+                       if pd.api.types.is_numeric_dtype(df[c])})
+
+def _with_subtotals(df, level):
+    ''' returns the rows of df with a subtotal row after each group at level and deeper,
+    groups in order of first appearance '''
+    n_levels = df.index.nlevels
+    if level == n_levels - 1:
+        return [df]
+    parts = []
+    for _, g in df.groupby(level=list(range(level + 1)), sort=False):
+        parts += _with_subtotals(g, level + 1)
+        label = g.index[0][:level + 1] + (NAME,) + ('',) * (n_levels - level - 2)
+        parts.append(_total_row(g, label))
+    return parts
+
+def _expected(df, rtotal=True, ctotal=True, subtotals=False):
+    parts = _with_subtotals(df, 0) if subtotals and df.index.nlevels > 1 else [df]
+    if ctotal:
+        label = (NAME,) + ('',) * (df.index.nlevels - 1) if df.index.nlevels > 1 else NAME
+        parts.append(_total_row(df, label))
+    res = pd.concat(parts)
+    if rtotal:
+        label = NAME if df.columns.nlevels == 1 else (NAME,) + ('',) * (df.columns.nlevels - 1)
+        numeric = [c for c in res.columns if pd.api.types.is_numeric_dtype(res[c])]
+        res[label] = res[numeric].sum(axis=1)
+    return res
+
+def _check(res, expected):
+    assert res.index.tolist() == expected.index.tolist()
+    assert list(res.index.names) == list(expected.index.names)
+    assert res.columns.tolist() == expected.columns.tolist()
+    for (_, a), (_, b) in zip(res.items(), expected.items()):
+        if pd.api.types.is_numeric_dtype(b):
+            assert a.dtype == b.dtype
+            np.testing.assert_allclose(a.to_numpy(), b.to_numpy(), rtol=1e-12)
+        else:
+            assert a.tolist() == b.tolist()
+
+@pytest.fixture
+def rows():
+    ''' a (region, commodity, use) multi-index whose groups are not contiguous '''
+    index = pd.MultiIndex.from_tuples(
+        [('r1', 'c1', 'u0'), ('r0', 'c0', 'u1'), ('r1', 'c0', 'u0'), ('r0', 'c1', 'u0'),
+         ('r1', 'c1', 'u1'), ('r0', 'c0', 'u0'), ('r2', 'c0', 'u0')],
+        names=['dim1', 'dim4', 'dim5'])
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'a': rng.normal(size=7), 'b': rng.normal(size=7)}, index=index)
+
+def test_series():
+    s = pd.Series([1.5, np.nan, 3.0], index=pd.Index(['r0', 'r1', 'r2'], name='dim1'),
+                  name='value')
+    expected = pd.concat([s, pd.Series([4.5], index=[NAME])])
+    for res in [metropy.add_ctotal(s), metropy.add_rtotal(s), metropy.add_margins(s)]:
+        assert metropy.is_series(res) and res.name == 'value'
+        assert res.index.tolist() == expected.index.tolist()
+        np.testing.assert_allclose(res.to_numpy(), expected.to_numpy())
+
+def test_series_subtotals(rows):
+    s = rows['a']
+    res = metropy.add_margins(s, subtotals=True)
+    _check(res.to_frame(), _expected(s.to_frame(), rtotal=False, subtotals=True))
+
+def test_single_index():
+    df = pd.DataFrame({'c0': [1.0, 2.0, np.nan], 'c1': [4.0, 5.0, 6.0]},
+                      index=pd.Index(['r1', 'r0', 'r2'], name='dim1'))
+    _check(metropy.add_margins(df), _expected(df))
+    _check(metropy.add_ctotal(df), _expected(df, rtotal=False))
+    _check(metropy.add_rtotal(df), _expected(df, ctotal=False))
+    _check(metropy.add_margins(df, subtotals=True), _expected(df))
+
+@pytest.mark.parametrize('n_levels', [2, 3])
+def test_subtotals(rows, n_levels):
+    df = rows.droplevel(list(range(n_levels, 3))) if n_levels < 3 else rows
+    _check(metropy.add_margins(df, subtotals=True), _expected(df, subtotals=True))
+    _check(metropy.add_margins(df, rtotal=False, ctotal=False, subtotals=True),
+           _expected(df, rtotal=False, ctotal=False, subtotals=True))
+
+def test_multiindex_columns(rows):
+    df = rows.copy()
+    df.columns = pd.MultiIndex.from_tuples([('value', 'c0'), ('value', 'c1')],
+                                           names=[None, 'dim4'])
+    res = metropy.add_margins(df, subtotals=True)
+    _check(res, _expected(df, subtotals=True))
+    assert res.columns.names == df.columns.names
+
+def test_non_numeric_and_int_columns(rows):
+    df = rows.assign(n=np.arange(7, dtype=np.int64), label=list('abcdefg'),
+                     k=np.arange(7, dtype=np.int32))
+    res = metropy.add_margins(df, subtotals=True)
+    _check(res, _expected(df, subtotals=True))
+    assert res['n'].dtype == np.int64 and res['k'].dtype == np.int32
+    assert res[NAME].dtype == np.float64
+
+    ints = df[['n']]
+    res = metropy.add_margins(ints, subtotals=True)
+    _check(res, _expected(ints, subtotals=True))
+    assert (res.dtypes == np.int64).all()
+
+def test_empty_frame():
+    df = pd.DataFrame({'a': pd.Series([], dtype=np.float64),
+                       'b': pd.Series([], dtype=np.int64)},
+                      index=pd.Index([], name='dim1', dtype=object))
+    res = metropy.add_margins(df)
+    _check(res, _expected(df))
+    assert res.loc[NAME].tolist() == [0, 0, 0]
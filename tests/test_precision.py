@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the error bounds of float32 precision documented in metro_data.set_precision()
+against float64 results
+
+run with: python -m pytest tests
+"""
+# third party imports
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('gdxpds')
+
+# local imports
+from metro import metropy
+from metro.stores import write_columnar
+
+EPS = 6e-8 # relative error bound of float32 values and sums
+
+def _results(seed, scale=1.0):
+    ''' returns a synthetic METRO results table with variables QER (dim1, dim2, dim4)
+    and QFD (dim1, dim4, dim5), values spanning several orders of magnitude '''
+    rng = np.random.default_rng(seed)
+    frames = []
+    for v, d2, d5 in [('QER', [f'w{i}' for i in range(6)], ['empty']),
+                      ('QFD', ['empty'], [f'u{i}' for i in range(4)])]:
+        index = pd.MultiIndex.from_product([[f'r{i}' for i in range(6)], d2, [v],
+                                            [f'c{i}' for i in range(8)], d5],
+                                           names=['dim1', 'dim2', 'variable', 'dim4', 'dim5'])
+        df = index.to_frame(index=False)
+        df['value'] = rng.lognormal(3, 2, len(df)) * rng.choice([-1, 1], len(df)) * scale
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def _scenario(path, dtype):
+    m = metropy.metro_data(str(path))
+    m.path = str(path)
+    m.set_precision(dtype)
+    return m
+
+@pytest.fixture
+def files(tmp_path):
+    ''' a base and a policy scenario as columnar copies '''
+    base = _results(1)
+    policy = base.assign(value=base['value'] * (1 + _results(2)['value'].abs() / 1e4))
+    paths = tmp_path / 'base.npz', tmp_path / 'policy.npz'
+    for df, path in zip([base, policy], paths):
+        write_columnar({'results': df}, str(path))
+    return paths
+
+@pytest.mark.parametrize('v', ['QER', 'QFD'])
+def test_values_and_get_variable(files, v):
+    m64, m32 = _scenario(files[0], np.float64), _scenario(files[0], np.float32)
+    x64, x32 = m64.data['results']['value'], m32.data['results']['value']
+    assert x32.dtype == np.float32
+    assert (np.abs(x32.astype(np.float64) - x64) <= EPS * np.abs(x64)).all()
+
+    df64, df32 = m64.get_variable(v), m32.get_variable(v)
+    assert (df32.dtypes == np.float32).all()
+    assert (np.abs(df32.to_numpy(np.float64) - df64.to_numpy()) <=
+            EPS * np.abs(df64.to_numpy())).all()
+
+@pytest.mark.parametrize('by', [(), ('dim1',), ('dim4',), ('dim1', 'dim4')])
+def test_get_total(files, by):
+    m64, m32 = _scenario(files[0], np.float64), _scenario(files[0], np.float32)
+    rows = m64.get_rows('QER')
+    bound = EPS * rows.groupby(list(by))['value'].apply(lambda x: x.abs().sum()) \
+        if by else EPS * rows['value'].abs().sum()
+    t64, t32 = m64.get_total('QER', by), m32.get_total('QER', by)
+    assert (np.abs(np.asarray(t32) - np.asarray(t64)) <= np.asarray(bound)).all()
+
+def test_pct_diff(files):
+    p64 = metropy.pct_diff(_scenario(files[0], np.float64).get_variable('QER'),
+                           _scenario(files[1], np.float64).get_variable('QER'))
+    p32 = metropy.pct_diff(_scenario(files[0], np.float32).get_variable('QER'),
+                           _scenario(files[1], np.float32).get_variable('QER'))
+    assert (p32.dtypes == np.float32).all()
+    pct = p64.to_numpy()
+    assert (np.abs(p32.to_numpy(np.float64) - pct) <= 2e-5 * (1 + np.abs(pct) / 100)).all()
+
+def test_raise_precision_after_eviction(files, tmp_path):
+    ''' going back to float64 reloads the file, not the float32 copy of an eviction '''
+    stack = metropy.result_stack()
+    for path in files:
+        stack.add_result(_scenario(path, np.float32))
+    stack.set_budget(max_scenarios=1, spill_dir=str(tmp_path))
+    for m in stack.stack:
+        m.data
+    base = stack.stack[0]
+    assert not base._data # evicted, with a float32 copy in tmp_path
+
+    base.set_precision(np.float64)
+    expected = _scenario(files[0], np.float64).get_variable('QER')
+    pd.testing.assert_frame_equal(base.get_variable('QER'), expected, check_exact=True)
+
+def test_compressed_precision(files):
+    ''' compressed stores keep float32, going back to float64 reloads the file '''
+    stack = metropy.result_stack()
+    stack.set_precision(np.float32)
+    for path in files:
+        stack.add_result(_scenario(path, np.float32))
+    stack.compress()
+    assert stack.stack[0]._store.values.dtype == np.float32
+    assert stack.stack[1]._store.delta.dtype == np.float32
+    assert (stack.get_var('QER')[str(files[1])].dtypes == np.float32).all()
+
+    stack.set_precision(np.float64)
+    for path, m in zip(files, stack.stack):
+        expected = _scenario(path, np.float64).get_variable('QER')
+        pd.testing.assert_frame_equal(m.get_variable('QER'), expected, check_exact=True)
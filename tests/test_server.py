@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the query server on localhost answers the same frames as the local API,
+in every format, and counts coalesced requests and cache hits
+
+run with: python -m pytest tests
+"""
+# standard library imports
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# third party imports
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('gdxpds')
+
+# local imports
+from metro import metropy
+from metro import server
+from metro.stores import write_columnar
+
+MACRO = ['rGDPEXP', 'rQABSORP', 'rQCDTOT', 'rQGDTOT', 'rQINVTOT', 'rEXPORT', 'rIMPORT']
+
+def _results(seed):
+    ''' returns a synthetic METRO results table with the macro variables and QER '''
+    rng = np.random.default_rng(seed)
+    regions = [f'r{i}' for i in range(4)]
+    rows = [(r, 'empty', v, 'empty', 'empty') for v in MACRO for r in regions]
+    rows += [(r, f'w{j}', 'QER', f'c{k}', 'empty')
+             for r in regions for j in range(4) for k in range(5)]
+    df = pd.DataFrame(rows, columns=['dim1', 'dim2', 'variable', 'dim4', 'dim5'])
+    df['value'] = rng.uniform(1, 100, len(df))
+    return df
+
+def _scenario(dataID, path):
+    m = metropy.metro_data(dataID)
+    m.path = str(path)
+    return m
+
+def _assert_same(a, b):
+    ''' asserts that frames or series a and b are equal '''
+    if isinstance(b, pd.Series):
+        pd.testing.assert_series_equal(a, b)
+    else:
+        pd.testing.assert_frame_equal(a, b)
+
+@pytest.fixture
+def files(tmp_path):
+    paths = {}
+    for i, dataID in enumerate(['base', 'fta']):
+        paths[dataID] = tmp_path / f'{dataID}.npz'
+        write_columnar({'results': _results(i)}, str(paths[dataID]))
+    return paths
+
+@pytest.fixture
+def srv(files):
+    stack = metropy.result_stack()
+    for dataID, path in files.items():
+        stack.add_result(_scenario(dataID, path))
+    srv = server.query_server(stack, port=0).start_background()
+    yield srv
+    srv.stop_background()
+
+@pytest.mark.parametrize('fmt', ['arrow', 'parquet', 'json'])
+def test_same_frames(files, srv, fmt):
+    if fmt != 'json':
+        pytest.importorskip('pyarrow')
+    client = server.query_client(port=srv.port, format=fmt)
+    assert client.get_dataIDs() == list(files)
+    for dataID, path in files.items():
+        local = _scenario(dataID, path) # not the object used by the server
+        for v in ['QER', 'rGDPEXP']:
+            _assert_same(client.get_variable(dataID, v), local.get_variable(v))
+        _assert_same(client.macro_table(dataID), metropy.macro_table(local))
+        assert client.dimensions(dataID) == local.dimensions
+    assert client.get_variable('base', 'nope') is None
+
+def test_coalesced_and_hits(srv):
+    client = server.query_client(port=srv.port, format='json')
+    gate = threading.Event()
+    srv._executor.submit(gate.wait) # holds the computations until all requests arrived
+
+    n = 8
+    with ThreadPoolExecutor(n) as pool:
+        futures = [pool.submit(client.get_variable, 'base', 'QER') for _ in range(n)]
+        t_end = time.monotonic() + 30
+        while srv.stats()['coalesced'] < n - 1 and time.monotonic() < t_end:
+            time.sleep(0.01)
+        gate.set()
+        frames = [f.result() for f in futures]
+    for df in frames[1:]:
+        pd.testing.assert_frame_equal(df, frames[0])
+
+    stats = client.stats()
+    assert (stats['computed'], stats['coalesced'], stats['hits']) == (1, n - 1, 0)
+    assert stats['entries'] == 1
+
+    client.get_variable('base', 'QER')
+    stats = client.stats()
+    assert (stats['computed'], stats['coalesced'], stats['hits']) == (1, n - 1, 1)
@@ -63,8 +63,8 @@ print(f'Row totals added:\n {metropy.add_rtotal(EXP_cuw)}')
 
 '''
 We can also combine row and column totals in one call.
-This returns a modified EXP_cuw with both row and column totals added.
-Because this alters the index, it is best to put the result in a new df, just so:
+This returns a copy of EXP_cuw with both row and column totals added, EXP_cuw
+itself is not changed, so we put the result in a new df, just so:
 '''
 EXP_cuw_withtotals=metropy.add_ctotal(metropy.add_rtotal(EXP_cuw), 'WORLD')
 
@@ -111,3 +111,13 @@ and adding row and column totals:
 '''
 mapped2=EXP_cuw.groupby(['dim1', 'dim4_map']).sum()
 mapped2 = metropy.add_ctotal(metropy.add_rtotal(mapped2, 'sum over uses'), 'sum over regions & commodities')
+
+'''
+Subtotals for every level of the row index are made in one call to add_margins(),
+which also adds the row and column totals. Here we get the exports of each region
+(dim1) summed over the destinations, and of each region-destination pair (dim2)
+summed over the commodities:
+'''
+EXP_cuw_subtotals = metropy.add_margins(EXP_cuw.drop(columns='dim4_map'), 'TOTAL', \
+                                        subtotals=True)
+print(EXP_cuw_subtotals.head(12))